@@ -3,7 +3,7 @@ import configparser
 from datetime import datetime
 
 
-def connect_to_db(create_schema=False):
+def connect_to_db(create_schema=False, allow_local_infile=False, autocommit=False):
     # Read the configuration file
     config = configparser.ConfigParser()
     config.read("config.ini")
@@ -13,7 +13,11 @@ def connect_to_db(create_schema=False):
 
     # Connect to the database server (initially without specifying the database)
     db_conn = mysql.connector.connect(
-        host=db_config["host"], user=db_config["user"], password=db_config["password"]
+        host=db_config["host"],
+        user=db_config["user"],
+        password=db_config["password"],
+        allow_local_infile=allow_local_infile,
+        autocommit=autocommit,
     )
     cursor = db_conn.cursor()
     try:
@@ -23,6 +27,18 @@ def connect_to_db(create_schema=False):
             db_conn.database = db_config["database"]
             create_plugin_data_table(cursor)
             create_plugin_results_table(cursor)
+            create_sync_state_table(cursor)
+            create_plugin_downloads_table(cursor)
+            create_plugin_audits_table(cursor)
+            create_file_cache_tables(cursor)
+            create_audit_runs_table(cursor)
+            create_interned_tables(cursor)
+            create_snippets_table(cursor)
+            add_missing_columns(cursor)
+            add_missing_indexes(cursor)
+            normalize_results_table(cursor)
+            move_snippets_out_of_results(cursor)
+            create_latest_results_view(cursor)
         else:
             db_conn.database = db_config["database"]
 
@@ -33,15 +49,12 @@ def connect_to_db(create_schema=False):
                     db_config["database"]
                 )
             )
+        # Anything else would leave a half migrated schema behind
+        raise
 
     return db_conn, cursor
 
 
-def delete_results_table(cursor):
-    cursor.execute("DROP TABLE IF EXISTS PluginResults")
-    create_plugin_results_table(cursor)
-
-
 def create_plugin_data_table(cursor):
     cursor.execute(
         """
@@ -52,7 +65,8 @@ def create_plugin_data_table(cursor):
         downloaded INT,
         last_updated DATETIME,
         added_date DATE,
-        download_link TEXT
+        download_link TEXT,
+        INDEX idx_active_installs (active_installs)
     )
     """
     )
@@ -64,19 +78,602 @@ def create_plugin_results_table(cursor):
     CREATE TABLE IF NOT EXISTS PluginResults (
         id INT AUTO_INCREMENT PRIMARY KEY,
         slug VARCHAR(255),
-        file_path VARCHAR(255),
+        path_id INT,
+        rule_id INT,
+        start_line INT,
+        end_line INT,
+        snippet_sha256 CHAR(64),
+        run_id INT,
+        FOREIGN KEY (slug) REFERENCES PluginData(slug),
+        INDEX idx_rule_id_slug (rule_id, slug),
+        INDEX idx_slug_path_id (slug, path_id),
+        INDEX idx_snippet_sha256 (snippet_sha256)
+    )
+    """
+    )
+
+
+def create_interned_tables(cursor):
+    # Rule names and file paths are long and repeated on lots of results, so results refer to
+    # them by id. Both compare case sensitively, unlike the default collation.
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS Rules (
+        rule_id INT AUTO_INCREMENT PRIMARY KEY,
+        check_id VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin UNIQUE
+    )
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS FilePaths (
+        path_id INT AUTO_INCREMENT PRIMARY KEY,
+        slug VARCHAR(255),
+        file_path VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin,
+        UNIQUE (slug, file_path)
+    )
+    """
+    )
+
+
+def get_rule_ids(cursor, check_ids, chunk_size=500):
+    # Returns {check_id: rule_id}, adding any rules that aren't in the table yet
+    check_ids = list(check_ids)
+    rule_ids = {}
+    for i in range(0, len(check_ids), chunk_size):
+        chunk = check_ids[i : i + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        sql = f"SELECT check_id, rule_id FROM Rules WHERE check_id IN ({placeholders})"
+        try:
+            cursor.execute(sql, chunk)
+        except mysql.connector.errors.ProgrammingError as e:
+            if "1146" in str(e):
+                raise SystemExit(
+                    "Table does not exist. Please run with the '--create-schema' flag to create the table."
+                )
+            raise
+        found = dict(cursor.fetchall())
+        missing = [check_id for check_id in chunk if check_id not in found]
+        if missing:
+            cursor.executemany(
+                "INSERT IGNORE INTO Rules (check_id) VALUES (%s)",
+                [(check_id,) for check_id in missing],
+            )
+            cursor.execute(sql, chunk)
+            found = dict(cursor.fetchall())
+        rule_ids.update(found)
+    return rule_ids
+
+
+def get_path_ids(cursor, paths, chunk_size=500):
+    # Returns {(slug, file_path): path_id}, adding any paths that aren't in the table yet
+    paths = list(paths)
+    path_ids = {}
+    for i in range(0, len(paths), chunk_size):
+        chunk = paths[i : i + chunk_size]
+        placeholders = ", ".join(["(%s, %s)"] * len(chunk))
+        sql = f"SELECT slug, file_path, path_id FROM FilePaths WHERE (slug, file_path) IN ({placeholders})"
+        params = [value for path in chunk for value in path]
+        try:
+            cursor.execute(sql, params)
+        except mysql.connector.errors.ProgrammingError as e:
+            if "1146" in str(e):
+                raise SystemExit(
+                    "Table does not exist. Please run with the '--create-schema' flag to create the table."
+                )
+            raise
+        found = {(slug, file_path): path_id for slug, file_path, path_id in cursor}
+        missing = [path for path in chunk if path not in found]
+        if missing:
+            cursor.executemany(
+                "INSERT IGNORE INTO FilePaths (slug, file_path) VALUES (%s, %s)",
+                missing,
+            )
+            cursor.execute(sql, params)
+            found = {(slug, file_path): path_id for slug, file_path, path_id in cursor}
+        path_ids.update(found)
+    return path_ids
+
+
+def create_snippets_table(cursor):
+    # The matched lines of each result, stored once per distinct snippet and keyed on its sha256.
+    # Compressed snippets are in the format of MySQL's COMPRESS(), so UNCOMPRESS() reads them.
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS Snippets (
+        snippet_sha256 CHAR(64) PRIMARY KEY,
+        compressed BOOLEAN,
+        content MEDIUMBLOB
+    )
+    """
+    )
+
+
+def insert_snippets(cursor, snippets):
+    # Snippets are (snippet_sha256, compressed, content), ones already stored are skipped
+    try:
+        cursor.executemany(
+            "INSERT IGNORE INTO Snippets (snippet_sha256, compressed, content) VALUES (%s, %s, %s)",
+            snippets,
+        )
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+        raise
+
+
+def move_snippets_out_of_results(cursor):
+    # Moves the snippets of results stored before the Snippets table existed into it, then drops
+    # the old column. A one-off, but it rewrites the whole table.
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = 'PluginResults'"
+    )
+    if "vuln_lines" not in {column.lower() for (column,) in cursor.fetchall()}:
+        return
+
+    print("Moving PluginResults snippets to the Snippets table, this can take a while.")
+    cursor.execute(
+        "INSERT IGNORE INTO Snippets (snippet_sha256, compressed, content) "
+        "SELECT SHA2(vuln_lines, 256), FALSE, vuln_lines FROM PluginResults WHERE vuln_lines IS NOT NULL"
+    )
+    cursor.execute(
+        "UPDATE PluginResults SET snippet_sha256 = SHA2(vuln_lines, 256) "
+        "WHERE snippet_sha256 IS NULL AND vuln_lines IS NOT NULL"
+    )
+    cursor.execute("ALTER TABLE PluginResults DROP COLUMN vuln_lines")
+
+
+def normalize_results_table(cursor):
+    # Moves results stored before rules and paths were interned over to ids, then drops the old
+    # columns (and their indexes). A one-off, but it rewrites the whole table.
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = 'PluginResults'"
+    )
+    if "check_id" not in {column.lower() for (column,) in cursor.fetchall()}:
+        return
+
+    print("Moving PluginResults over to rule and path ids, this can take a while.")
+    cursor.execute(
+        "INSERT IGNORE INTO Rules (check_id) "
+        "SELECT DISTINCT check_id FROM PluginResults WHERE check_id IS NOT NULL"
+    )
+    cursor.execute(
+        "INSERT IGNORE INTO FilePaths (slug, file_path) "
+        "SELECT DISTINCT slug, file_path FROM PluginResults WHERE file_path IS NOT NULL"
+    )
+    cursor.execute(
+        """
+    UPDATE PluginResults
+    JOIN Rules ON Rules.check_id = CONVERT(PluginResults.check_id USING utf8mb4) COLLATE utf8mb4_bin
+    JOIN FilePaths ON FilePaths.slug = PluginResults.slug
+        AND FilePaths.file_path = CONVERT(PluginResults.file_path USING utf8mb4) COLLATE utf8mb4_bin
+    SET PluginResults.rule_id = Rules.rule_id, PluginResults.path_id = FilePaths.path_id
+    WHERE PluginResults.rule_id IS NULL
+    """
+    )
+
+    cursor.execute(
+        "SELECT DISTINCT index_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = 'PluginResults'"
+    )
+    drop = [
+        f"DROP INDEX {index}"
+        for (index,) in cursor.fetchall()
+        if index in ("idx_check_id_slug", "idx_slug_file_path")
+    ]
+    cursor.execute(
+        "ALTER TABLE PluginResults "
+        + ", ".join(drop + ["DROP COLUMN check_id", "DROP COLUMN file_path"])
+    )
+
+
+def create_audit_runs_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS AuditRuns (
+        run_id INT AUTO_INCREMENT PRIMARY KEY,
+        rules_hash CHAR(64),
+        started_at DATETIME,
+        completed_at DATETIME
+    )
+    """
+    )
+
+
+def create_latest_results_view(cursor):
+    # Every audit writes its results under a new run_id, and a plugin's results only switch over
+    # to the new run when its PluginAudits row is pointed at it, in the same transaction. Query
+    # this view rather than PluginResults to only see the latest completed audit of each plugin.
+    # Results from before runs existed have no run_id, and match ledger rows without one.
+    cursor.execute(
+        """
+    CREATE OR REPLACE VIEW LatestPluginResults AS
+    SELECT PluginResults.id, PluginResults.slug, FilePaths.file_path, Rules.check_id,
+        PluginResults.start_line, PluginResults.end_line,
+        CONVERT(
+            IF(Snippets.compressed, UNCOMPRESS(Snippets.content), Snippets.content)
+            USING utf8mb4
+        ) AS vuln_lines,
+        PluginResults.run_id
+    FROM PluginResults
+    JOIN Rules ON Rules.rule_id = PluginResults.rule_id
+    JOIN FilePaths ON FilePaths.path_id = PluginResults.path_id
+    LEFT JOIN Snippets ON Snippets.snippet_sha256 = PluginResults.snippet_sha256
+    LEFT JOIN PluginAudits ON PluginAudits.slug = PluginResults.slug
+    WHERE PluginAudits.run_id <=> PluginResults.run_id
+    """
+    )
+
+
+def start_audit_run(cursor, rules_hash):
+    try:
+        cursor.execute(
+            "INSERT INTO AuditRuns (rules_hash, started_at) VALUES (%s, %s)",
+            (rules_hash, datetime.now()),
+        )
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+        raise
+    return cursor.lastrowid
+
+
+def complete_audit_run(cursor, run_id):
+    cursor.execute(
+        "UPDATE AuditRuns SET completed_at = %s WHERE run_id = %s",
+        (datetime.now(), run_id),
+    )
+
+
+def forget_earlier_audits(cursor, run_id, keep=()):
+    # Drops plugins that weren't audited in this run from LatestPluginResults, so their results
+    # get pruned as well. Plugins whose scan failed (keep) hold on to their earlier results.
+    cursor.execute(
+        "SELECT slug FROM PluginAudits WHERE run_id IS NULL OR run_id <> %s", (run_id,)
+    )
+    slugs = [(slug,) for (slug,) in cursor.fetchall() if slug not in keep]
+    cursor.executemany("DELETE FROM PluginAudits WHERE slug = %s", slugs)
+
+
+def prune_results(cursor, before_run_id, after_id=0, chunk_size=10000):
+    # Deletes one chunk of results from earlier runs that are no longer the latest for their
+    # plugin, walking the table in id order. Returns the last id looked at, or None when done.
+    cursor.execute(
+        """
+    SELECT PluginResults.id,
+        PluginAudits.run_id <=> PluginResults.run_id
+    FROM PluginResults
+    LEFT JOIN PluginAudits ON PluginAudits.slug = PluginResults.slug
+    WHERE PluginResults.id > %s
+        AND (PluginResults.run_id IS NULL OR PluginResults.run_id < %s)
+    ORDER BY PluginResults.id
+    LIMIT %s
+    """,
+        (after_id, before_run_id, chunk_size),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    superseded = [result_id for result_id, current in rows if not current]
+    if superseded:
+        placeholders = ", ".join(["%s"] * len(superseded))
+        cursor.execute(
+            f"DELETE FROM PluginResults WHERE id IN ({placeholders})", superseded
+        )
+    return rows[-1][0]
+
+
+# Columns added after the tables were first created, added to existing databases by
+# add_missing_columns
+COLUMNS = [
+    ("PluginResults", "run_id", "INT"),
+    ("PluginAudits", "run_id", "INT"),
+    ("PluginResults", "path_id", "INT"),
+    ("PluginResults", "rule_id", "INT"),
+    ("PluginResults", "snippet_sha256", "CHAR(64)"),
+]
+
+
+def prune_snippets(cursor, after_sha256="", chunk_size=10000):
+    # Deletes one chunk of snippets that no result points at any more, walking the table in hash
+    # order. Returns the last hash looked at, or None when done.
+    cursor.execute(
+        """
+    SELECT Snippets.snippet_sha256,
+        EXISTS (
+            SELECT 1 FROM PluginResults
+            WHERE PluginResults.snippet_sha256 = Snippets.snippet_sha256
+        )
+    FROM Snippets
+    WHERE Snippets.snippet_sha256 > %s
+    ORDER BY Snippets.snippet_sha256
+    LIMIT %s
+    """,
+        (after_sha256, chunk_size),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    orphaned = [(snippet_sha256,) for snippet_sha256, used in rows if not used]
+    cursor.executemany("DELETE FROM Snippets WHERE snippet_sha256 = %s", orphaned)
+    return rows[-1][0]
+
+
+def add_missing_columns(cursor):
+    cursor.execute(
+        "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = DATABASE()"
+    )
+    existing = {(table.lower(), column.lower()) for table, column in cursor.fetchall()}
+    for table, column, definition in COLUMNS:
+        if (table.lower(), column.lower()) not in existing:
+            print(f"Adding column {column} to {table}, this can take a while.")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# Indexes for the triage queries, also in the CREATE TABLE statements above. Databases created
+# before they were added get them from add_missing_indexes.
+INDEXES = [
+    ("PluginData", "idx_active_installs", "(active_installs)"),
+    ("PluginResults", "idx_rule_id_slug", "(rule_id, slug)"),
+    ("PluginResults", "idx_slug_path_id", "(slug, path_id)"),
+    ("PluginResults", "idx_snippet_sha256", "(snippet_sha256)"),
+]
+
+
+def add_missing_indexes(cursor):
+    cursor.execute(
+        "SELECT table_name, index_name FROM information_schema.statistics WHERE table_schema = DATABASE()"
+    )
+    existing = {(table.lower(), index) for table, index in cursor.fetchall()}
+    for table, index, columns in INDEXES:
+        if (table.lower(), index) not in existing:
+            print(f"Adding index {index} to {table}, this can take a while.")
+            cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} {columns}")
+
+
+def create_sync_state_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SyncState (
+        name VARCHAR(255) PRIMARY KEY,
+        last_updated DATETIME
+    )
+    """
+    )
+
+
+def get_sync_watermark(cursor, name="catalog"):
+    try:
+        cursor.execute(
+            "SELECT last_updated FROM SyncState WHERE name = %s",
+            (name,),
+        )
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+        raise
+
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def set_sync_watermark(cursor, last_updated, name="catalog"):
+    sql = """
+    INSERT INTO SyncState (name, last_updated)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE
+        last_updated = VALUES(last_updated)
+    """
+    cursor.execute(sql, (name, last_updated))
+
+
+def create_plugin_downloads_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginDownloads (
+        slug VARCHAR(255) PRIMARY KEY,
+        version VARCHAR(255),
+        archive_sha256 CHAR(64),
+        downloaded_at DATETIME
+    )
+    """
+    )
+
+
+def get_download_manifest(cursor):
+    try:
+        cursor.execute("SELECT slug, version FROM PluginDownloads")
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+        raise
+
+    return dict(cursor.fetchall())
+
+
+def record_plugin_download(cursor, slug, version, archive_sha256):
+    sql = """
+    INSERT INTO PluginDownloads (slug, version, archive_sha256, downloaded_at)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        version = VALUES(version),
+        archive_sha256 = VALUES(archive_sha256),
+        downloaded_at = VALUES(downloaded_at)
+    """
+    cursor.execute(sql, (slug, version, archive_sha256, datetime.now()))
+
+
+def create_plugin_audits_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginAudits (
+        slug VARCHAR(255) PRIMARY KEY,
+        version VARCHAR(255),
+        rules_hash CHAR(64),
+        scanned_at DATETIME,
+        run_id INT
+    )
+    """
+    )
+
+
+def get_audit_ledger(cursor):
+    try:
+        cursor.execute("SELECT slug, version, rules_hash FROM PluginAudits")
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+        raise
+
+    return {slug: (version, rules_hash) for slug, version, rules_hash in cursor}
+
+
+def record_plugin_audit(cursor, slug, version, rules_hash, run_id):
+    # Also switches LatestPluginResults over to the results of this run for the plugin
+    sql = """
+    INSERT INTO PluginAudits (slug, version, rules_hash, scanned_at, run_id)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        version = VALUES(version),
+        rules_hash = VALUES(rules_hash),
+        scanned_at = VALUES(scanned_at),
+        run_id = VALUES(run_id)
+    """
+    cursor.execute(sql, (slug, version, rules_hash, datetime.now(), run_id))
+
+
+def create_file_cache_tables(cursor):
+    # Files that have been scanned with a set of rules, keyed on the sha256 of the file content
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SemgrepFileCache (
+        file_sha256 CHAR(64),
+        rules_hash CHAR(64),
+        scanned_at DATETIME,
+        PRIMARY KEY (file_sha256, rules_hash)
+    )
+    """
+    )
+    # The findings for those files, files without findings just have a SemgrepFileCache row
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SemgrepCachedFindings (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        file_sha256 CHAR(64),
+        rules_hash CHAR(64),
         check_id VARCHAR(255),
         start_line INT,
         end_line INT,
         vuln_lines TEXT,
-        FOREIGN KEY (slug) REFERENCES PluginData(slug)
+        INDEX (file_sha256, rules_hash)
     )
     """
     )
 
 
-def insert_plugin_into_db(cursor, plugin):
-    # Prepare SQL upsert statement
+def get_cached_file_hashes(cursor, rules_hash, file_hashes, chunk_size=500):
+    # Returns the file hashes that have already been scanned with these rules
+    cached = set()
+    file_hashes = list(file_hashes)
+    for i in range(0, len(file_hashes), chunk_size):
+        chunk = file_hashes[i : i + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        try:
+            cursor.execute(
+                "SELECT file_sha256 FROM SemgrepFileCache "
+                f"WHERE rules_hash = %s AND file_sha256 IN ({placeholders})",
+                (rules_hash, *chunk),
+            )
+        except mysql.connector.errors.ProgrammingError as e:
+            if "1146" in str(e):
+                raise SystemExit(
+                    "Table does not exist. Please run with the '--create-schema' flag to create the table."
+                )
+            raise
+        cached.update(file_hash for (file_hash,) in cursor.fetchall())
+
+    return cached
+
+
+def get_cached_findings(cursor, rules_hash, file_hashes, chunk_size=500):
+    # Returns the cached findings (in semgrep's result format, minus the path) for every file
+    # hash that has already been scanned with these rules
+    cached = {
+        file_hash: []
+        for file_hash in get_cached_file_hashes(
+            cursor, rules_hash, file_hashes, chunk_size
+        )
+    }
+    found = list(cached)
+    for i in range(0, len(found), chunk_size):
+        chunk = found[i : i + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            "SELECT file_sha256, check_id, start_line, end_line, vuln_lines FROM SemgrepCachedFindings "
+            f"WHERE rules_hash = %s AND file_sha256 IN ({placeholders}) ORDER BY id",
+            (rules_hash, *chunk),
+        )
+        for file_hash, check_id, start_line, end_line, vuln_lines in cursor.fetchall():
+            cached[file_hash].append(
+                {
+                    "check_id": check_id,
+                    "start": {"line": start_line},
+                    "end": {"line": end_line},
+                    "extra": {"lines": vuln_lines},
+                }
+            )
+
+    return cached
+
+
+def insert_cached_findings(cursor, rules_hash, file_hash, findings):
+    cursor.execute(
+        "INSERT IGNORE INTO SemgrepFileCache (file_sha256, rules_hash, scanned_at) VALUES (%s, %s, %s)",
+        (file_hash, rules_hash, datetime.now()),
+    )
+    # Another worker may have scanned an identical file in the meantime
+    if cursor.rowcount != 1:
+        return
+
+    cursor.executemany(
+        "INSERT INTO SemgrepCachedFindings (file_sha256, rules_hash, check_id, start_line, end_line, vuln_lines) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        [
+            (
+                file_hash,
+                rules_hash,
+                finding["check_id"],
+                finding["start"]["line"],
+                finding["end"]["line"],
+                finding["extra"]["lines"],
+            )
+            for finding in findings
+        ],
+    )
+
+
+def delete_plugin_results(cursor, slug, run_id):
+    cursor.execute(
+        "DELETE FROM PluginResults WHERE slug = %s AND run_id = %s", (slug, run_id)
+    )
+
+
+def insert_plugins_into_db(cursor, plugins):
+    # Prepare SQL upsert statement, executemany turns this into a single multi-row upsert
     sql = """
     INSERT INTO PluginData (slug, version, active_installs, downloaded, last_updated, added_date, download_link)
     VALUES (%s, %s, %s, %s, %s, %s, %s)
@@ -88,7 +685,18 @@ def insert_plugin_into_db(cursor, plugin):
         added_date = VALUES(added_date),
         download_link = VALUES(download_link)
     """
+    data = [plugin_row(plugin) for plugin in plugins]
+
+    try:
+        cursor.executemany(sql, data)
+    except mysql.connector.errors.ProgrammingError as e:
+        if "1146" in str(e):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
 
+
+def plugin_row(plugin):
     # Prepare data for database insertion
     last_updated = plugin.get("last_updated", None)
     added_date = plugin.get("added", None)
@@ -101,7 +709,7 @@ def insert_plugin_into_db(cursor, plugin):
     if added_date:
         added_date = datetime.strptime(added_date, "%Y-%m-%d").strftime("%Y-%m-%d")
 
-    data = (
+    return (
         plugin["slug"],
         plugin.get("version", "N/A"),
         int(plugin.get("active_installs", 0)),
@@ -111,8 +719,16 @@ def insert_plugin_into_db(cursor, plugin):
         plugin.get("download_link", "N/A"),
     )
 
+
+def insert_results_into_db(cursor, rows):
+    # executemany turns this into a single multi-row INSERT, rows come from result_row
+    sql = (
+        "INSERT INTO PluginResults (slug, path_id, rule_id, start_line, end_line, snippet_sha256, run_id) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+    )
     try:
-        cursor.execute(sql, data)
+        cursor.executemany(sql, rows)
+
     except mysql.connector.errors.ProgrammingError as e:
         if "1146" in str(e):
             raise SystemExit(
@@ -120,24 +736,50 @@ def insert_plugin_into_db(cursor, plugin):
             )
 
 
-def insert_result_into_db(cursor, slug, result):
-    sql = (
-        "INSERT INTO PluginResults (slug, file_path, check_id, start_line, end_line, vuln_lines)"
-        "VALUES (%s, %s, %s, %s, %s, %s)"
-    )
-    data = (
+def result_row(slug, path_id, rule_id, snippet_sha256, result, run_id):
+    return (
         slug,
-        result["path"],
-        result["check_id"],
+        path_id,
+        rule_id,
         result["start"]["line"],
         result["end"]["line"],
-        result["extra"]["lines"],
+        snippet_sha256,
+        run_id,
+    )
+
+
+def load_results_into_db(cursor, path):
+    # Bulk load a tab separated spool of results (in the same column order as result_row). Needs
+    # local_infile enabled on the server as well as the connection.
+    sql = (
+        "LOAD DATA LOCAL INFILE %s INTO TABLE PluginResults CHARACTER SET utf8mb4 "
+        "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+        "(slug, path_id, rule_id, start_line, end_line, snippet_sha256, run_id)"
     )
     try:
-        cursor.execute(sql, data)
+        cursor.execute(sql, (path,))
 
     except mysql.connector.errors.ProgrammingError as e:
         if "1146" in str(e):
             raise SystemExit(
                 "Table does not exist. Please run with the '--create-schema' flag to create the table."
             )
+
+
+def iter_plugin_data(cursor, chunk_size=100000):
+    # Streams the catalog in chunks of rows, for exporting
+    cursor.execute(
+        "SELECT slug, version, active_installs, downloaded, last_updated, added_date, download_link FROM PluginData"
+    )
+    while rows := cursor.fetchmany(chunk_size):
+        yield rows
+
+
+def iter_latest_results(cursor, chunk_size=100000):
+    # Streams the latest results of every plugin in chunks of rows, for exporting. The cursor is
+    # unbuffered so only one chunk is held at a time.
+    cursor.execute(
+        "SELECT slug, file_path, check_id, start_line, end_line, vuln_lines FROM LatestPluginResults"
+    )
+    while rows := cursor.fetchmany(chunk_size):
+        yield rows
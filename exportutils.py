@@ -0,0 +1,86 @@
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Columns that repeat a lot are dictionary encoded, in Arrow as well as in the Parquet files
+def plugin_data_schema():
+    return pa.schema(
+        [
+            ("slug", pa.string()),
+            ("version", pa.dictionary(pa.int32(), pa.string())),
+            ("active_installs", pa.int64()),
+            ("downloaded", pa.int64()),
+            ("last_updated", pa.timestamp("s")),
+            ("added_date", pa.date32()),
+            ("download_link", pa.string()),
+        ]
+    )
+
+
+def results_schema():
+    return pa.schema(
+        [
+            ("slug", pa.dictionary(pa.int32(), pa.string())),
+            ("file_path", pa.string()),
+            ("check_id", pa.string()),
+            ("start_line", pa.int64()),
+            ("end_line", pa.int64()),
+            ("vuln_lines", pa.string()),
+        ]
+    )
+
+
+def to_record_batch(rows, schema):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def export_plugin_data(chunks, export_dir):
+    path = os.path.join(export_dir, "PluginData.parquet")
+    schema = plugin_data_schema()
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in chunks:
+            writer.write_batch(to_record_batch(rows, schema))
+    return path
+
+
+def export_results(chunks, export_dir, max_rows_per_file=1000000):
+    # Partitioned by rule (PluginResults/check_id=.../*.parquet) so a query for one rule only
+    # reads that rule's files. Batches are written out as they arrive, with a file kept open per
+    # rule, so memory doesn't grow with the number of results.
+    path = os.path.join(export_dir, "PluginResults")
+    schema = results_schema()
+    ds.write_dataset(
+        (to_record_batch(rows, schema) for rows in chunks),
+        path,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([schema.field("check_id")]), flavor="hive"
+        ),
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        max_rows_per_file=max_rows_per_file,
+        max_rows_per_group=min(max_rows_per_file, 128 * 1024),
+        existing_data_behavior="delete_matching",
+    )
+    return path
+
+
+def export_to_parquet(plugin_data, results, export_dir):
+    if pa is None:
+        raise SystemExit(
+            "Exporting to Parquet needs pyarrow, install it with 'pip install pyarrow'."
+        )
+
+    os.makedirs(export_dir, exist_ok=True)
+    print(f"Exported plugin data to {export_plugin_data(plugin_data, export_dir)}.")
+    print(f"Exported results to {export_results(results, export_dir)}.")
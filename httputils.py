@@ -0,0 +1,17 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_size=10):
+    session = requests.Session()
+
+    # Keep-alive connections are pooled per host (api.wordpress.org, downloads.wordpress.org), so
+    # size the pool to match the number of threads sharing the session. Blocking when the pool is
+    # exhausted caps the number of connections we open to any one host.
+    adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    return session
@@ -0,0 +1,183 @@
+import json
+import re
+
+READ_SIZE = 64 * 1024
+
+# Used to skip over values without decoding them, only brackets and strings matter for that
+STRUCTURE = re.compile(r'[\[\]{}"]')
+STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+# A number is only complete once it's followed by one of these
+NUMBER_START = "-0123456789"
+NUMBER_END = ",]} \t\r\n"
+
+
+class JSONStreamParser:
+    # Walks a single top-level JSON object read from a file-like stream, without needing the
+    # whole document in memory, and yields the items of one of its array members as they arrive
+    def __init__(self, stream, read_size=READ_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+        # Other members of the top-level object that iter_array was asked to keep
+        self.members = {}
+
+    def read(self):
+        # Drop whatever has already been parsed before reading more
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+
+        chunk = self.stream.read(self.read_size)
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise json.JSONDecodeError(
+                    "Unexpected end of document", self.buffer, self.pos
+                )
+            self.read()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.read()
+                continue
+
+            # A number at the end of the buffer might carry on in the next chunk, and "-2." or
+            # "1e" decode as -2 and 1 with the rest still to come
+            if (
+                not self.eof
+                and self.buffer[self.pos] in NUMBER_START
+                and (end == len(self.buffer) or self.buffer[end] not in NUMBER_END)
+            ):
+                self.read()
+                continue
+
+            self.pos = end
+            return value
+
+    def skip(self):
+        # Step over a value by matching up its brackets, nothing inside it is built
+        if self.peek() not in "[{":
+            self.value()
+            return
+
+        depth = 0
+        while True:
+            match = STRUCTURE.search(self.buffer, self.pos)
+            if not match:
+                self.pos = len(self.buffer)
+            elif match.group() == '"':
+                end = STRING_END.match(self.buffer, match.end())
+                if end:
+                    self.pos = end.end()
+                    continue
+                # The string carries on in the next chunk
+                self.pos = match.start()
+            else:
+                self.pos = match.end()
+                depth += 1 if match.group() in "[{" else -1
+                if depth == 0:
+                    return
+                continue
+
+            if self.eof:
+                raise json.JSONDecodeError(
+                    "Unexpected end of document", self.buffer, self.pos
+                )
+            self.read()
+
+    def select(self, fields):
+        # Decode only the given members of an object (nested as a dict of the members wanted from
+        # each of them, or None for the whole value) and skip over the rest. For an array they're
+        # selected from each of its items.
+        if fields is not None and self.peek() == "[":
+            items = []
+            self.expect("[")
+            if self.peek() == "]":
+                self.pos += 1
+                return items
+            while True:
+                items.append(self.select(fields))
+                if self.peek() != ",":
+                    break
+                self.pos += 1
+            self.expect("]")
+            return items
+
+        if fields is None or self.peek() != "{":
+            return self.value()
+
+        selected = {}
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return selected
+
+        while True:
+            name = self.value()
+            self.expect(":")
+            if name in fields:
+                selected[name] = self.select(fields[name])
+            else:
+                self.skip()
+
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.expect("}")
+        return selected
+
+    def iter_array(self, key, fields=None, keep=None):
+        # keep maps other members to decode (and the fields wanted from them) into self.members,
+        # they're only all there once the whole object has been read
+        self.expect("{")
+        if self.peek() == "}":
+            return
+
+        while True:
+            name = self.value()
+            self.expect(":")
+            if name == key:
+                self.expect("[")
+                if self.peek() != "]":
+                    while True:
+                        yield self.select(fields)
+                        if self.peek() != ",":
+                            break
+                        self.pos += 1
+                self.expect("]")
+            elif keep and name in keep:
+                self.members[name] = self.select(keep[name])
+            else:
+                self.skip()
+
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.expect("}")
+
+
+def iter_array_items(stream, key, fields=None, read_size=READ_SIZE):
+    return JSONStreamParser(stream, read_size).iter_array(key, fields)
@@ -0,0 +1,612 @@
+import hashlib
+import sqlite3
+from datetime import datetime
+from dbutils import COLUMNS, INDEXES, plugin_row, result_row
+
+# Storage backend for single machine runs, with the same functions as dbutils but writing to a
+# local SQLite database (selected with --db sqlite:///path) instead of a MySQL server
+
+TABLES = [
+    "PluginData",
+    "PluginResults",
+    "SyncState",
+    "PluginDownloads",
+    "PluginAudits",
+    "SemgrepFileCache",
+    "SemgrepCachedFindings",
+    "AuditRuns",
+    "Rules",
+    "FilePaths",
+    "Snippets",
+]
+
+
+def connect_to_db(create_schema=False, path=None, autocommit=False):
+    # Writers wait on each other's transactions rather than failing straight away, there's only
+    # one writer for the results but the pruning thread writes too
+    db_conn = sqlite3.connect(
+        path,
+        timeout=60,
+        isolation_level=None if autocommit else "",
+        check_same_thread=False,
+        # Statements are prepared once and reused from this cache
+        cached_statements=256,
+    )
+    cursor = db_conn.cursor()
+
+    # WAL lets the worker threads read while the results are written, and with it fsyncing on
+    # checkpoints rather than every commit is still safe against corruption
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -65536")
+
+    if create_schema:
+        create_plugin_data_table(cursor)
+        create_plugin_results_table(cursor)
+        create_sync_state_table(cursor)
+        create_plugin_downloads_table(cursor)
+        create_plugin_audits_table(cursor)
+        create_file_cache_tables(cursor)
+        create_audit_runs_table(cursor)
+        create_interned_tables(cursor)
+        create_snippets_table(cursor)
+        add_missing_columns(cursor)
+        normalize_results_table(cursor)
+        move_snippets_out_of_results(cursor)
+        add_missing_indexes(cursor)
+        create_latest_results_view(cursor)
+        db_conn.commit()
+    else:
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+                ", ".join("?" * len(TABLES))
+            ),
+            TABLES,
+        )
+        if cursor.fetchone()[0] < len(TABLES):
+            raise SystemExit(
+                "Table does not exist. Please run with the '--create-schema' flag to create the table."
+            )
+
+    return db_conn, cursor
+
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def create_plugin_data_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginData (
+        slug TEXT PRIMARY KEY,
+        version TEXT,
+        active_installs INTEGER,
+        downloaded INTEGER,
+        last_updated TEXT,
+        added_date TEXT,
+        download_link TEXT
+    )
+    """
+    )
+
+
+def create_plugin_results_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginResults (
+        id INTEGER PRIMARY KEY,
+        slug TEXT REFERENCES PluginData(slug),
+        path_id INTEGER,
+        rule_id INTEGER,
+        start_line INTEGER,
+        end_line INTEGER,
+        snippet_sha256 TEXT,
+        run_id INTEGER
+    )
+    """
+    )
+
+
+def create_sync_state_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SyncState (
+        name TEXT PRIMARY KEY,
+        last_updated TEXT
+    )
+    """
+    )
+
+
+def get_sync_watermark(cursor, name="catalog"):
+    cursor.execute("SELECT last_updated FROM SyncState WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+
+def set_sync_watermark(cursor, last_updated, name="catalog"):
+    sql = """
+    INSERT INTO SyncState (name, last_updated)
+    VALUES (?, ?)
+    ON CONFLICT (name) DO UPDATE SET
+        last_updated = excluded.last_updated
+    """
+    cursor.execute(sql, (name, last_updated.strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def create_plugin_downloads_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginDownloads (
+        slug TEXT PRIMARY KEY,
+        version TEXT,
+        archive_sha256 TEXT,
+        downloaded_at TEXT
+    )
+    """
+    )
+
+
+def get_download_manifest(cursor):
+    cursor.execute("SELECT slug, version FROM PluginDownloads")
+    return dict(cursor.fetchall())
+
+
+def record_plugin_download(cursor, slug, version, archive_sha256):
+    sql = """
+    INSERT INTO PluginDownloads (slug, version, archive_sha256, downloaded_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (slug) DO UPDATE SET
+        version = excluded.version,
+        archive_sha256 = excluded.archive_sha256,
+        downloaded_at = excluded.downloaded_at
+    """
+    cursor.execute(sql, (slug, version, archive_sha256, now()))
+
+
+def create_plugin_audits_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS PluginAudits (
+        slug TEXT PRIMARY KEY,
+        version TEXT,
+        rules_hash TEXT,
+        scanned_at TEXT,
+        run_id INTEGER
+    )
+    """
+    )
+
+
+def get_audit_ledger(cursor):
+    cursor.execute("SELECT slug, version, rules_hash FROM PluginAudits")
+    return {slug: (version, rules_hash) for slug, version, rules_hash in cursor}
+
+
+def record_plugin_audit(cursor, slug, version, rules_hash, run_id):
+    # Also switches LatestPluginResults over to the results of this run for the plugin
+    sql = """
+    INSERT INTO PluginAudits (slug, version, rules_hash, scanned_at, run_id)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (slug) DO UPDATE SET
+        version = excluded.version,
+        rules_hash = excluded.rules_hash,
+        scanned_at = excluded.scanned_at,
+        run_id = excluded.run_id
+    """
+    cursor.execute(sql, (slug, version, rules_hash, now(), run_id))
+
+
+def create_file_cache_tables(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SemgrepFileCache (
+        file_sha256 TEXT,
+        rules_hash TEXT,
+        scanned_at TEXT,
+        PRIMARY KEY (file_sha256, rules_hash)
+    )
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS SemgrepCachedFindings (
+        id INTEGER PRIMARY KEY,
+        file_sha256 TEXT,
+        rules_hash TEXT,
+        check_id TEXT,
+        start_line INTEGER,
+        end_line INTEGER,
+        vuln_lines TEXT
+    )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_cached_findings_file "
+        "ON SemgrepCachedFindings (file_sha256, rules_hash)"
+    )
+
+
+def get_cached_file_hashes(cursor, rules_hash, file_hashes, chunk_size=500):
+    # Returns the file hashes that have already been scanned with these rules
+    cached = set()
+    file_hashes = list(file_hashes)
+    for i in range(0, len(file_hashes), chunk_size):
+        chunk = file_hashes[i : i + chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            "SELECT file_sha256 FROM SemgrepFileCache "
+            f"WHERE rules_hash = ? AND file_sha256 IN ({placeholders})",
+            (rules_hash, *chunk),
+        )
+        cached.update(file_hash for (file_hash,) in cursor.fetchall())
+
+    return cached
+
+
+def get_cached_findings(cursor, rules_hash, file_hashes, chunk_size=500):
+    # Returns the cached findings (in semgrep's result format, minus the path) for every file
+    # hash that has already been scanned with these rules
+    cached = {
+        file_hash: []
+        for file_hash in get_cached_file_hashes(
+            cursor, rules_hash, file_hashes, chunk_size
+        )
+    }
+    found = list(cached)
+    for i in range(0, len(found), chunk_size):
+        chunk = found[i : i + chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            "SELECT file_sha256, check_id, start_line, end_line, vuln_lines FROM SemgrepCachedFindings "
+            f"WHERE rules_hash = ? AND file_sha256 IN ({placeholders}) ORDER BY id",
+            (rules_hash, *chunk),
+        )
+        for file_hash, check_id, start_line, end_line, vuln_lines in cursor.fetchall():
+            cached[file_hash].append(
+                {
+                    "check_id": check_id,
+                    "start": {"line": start_line},
+                    "end": {"line": end_line},
+                    "extra": {"lines": vuln_lines},
+                }
+            )
+
+    return cached
+
+
+def insert_cached_findings(cursor, rules_hash, file_hash, findings):
+    cursor.execute(
+        "INSERT OR IGNORE INTO SemgrepFileCache (file_sha256, rules_hash, scanned_at) VALUES (?, ?, ?)",
+        (file_hash, rules_hash, now()),
+    )
+    # Another worker may have scanned an identical file in the meantime
+    if cursor.rowcount != 1:
+        return
+
+    cursor.executemany(
+        "INSERT INTO SemgrepCachedFindings (file_sha256, rules_hash, check_id, start_line, end_line, vuln_lines) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                file_hash,
+                rules_hash,
+                finding["check_id"],
+                finding["start"]["line"],
+                finding["end"]["line"],
+                finding["extra"]["lines"],
+            )
+            for finding in findings
+        ],
+    )
+
+
+def delete_plugin_results(cursor, slug, run_id):
+    cursor.execute(
+        "DELETE FROM PluginResults WHERE slug = ? AND run_id = ?", (slug, run_id)
+    )
+
+
+def insert_plugins_into_db(cursor, plugins):
+    sql = """
+    INSERT INTO PluginData (slug, version, active_installs, downloaded, last_updated, added_date, download_link)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (slug) DO UPDATE SET
+        version = excluded.version,
+        active_installs = excluded.active_installs,
+        downloaded = excluded.downloaded,
+        last_updated = excluded.last_updated,
+        added_date = excluded.added_date,
+        download_link = excluded.download_link
+    """
+    cursor.executemany(sql, [plugin_row(plugin) for plugin in plugins])
+
+
+def insert_results_into_db(cursor, rows):
+    sql = (
+        "INSERT INTO PluginResults (slug, path_id, rule_id, start_line, end_line, snippet_sha256, run_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+    cursor.executemany(sql, rows)
+
+
+def create_interned_tables(cursor):
+    # See dbutils.create_interned_tables, SQLite compares text case sensitively already
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS Rules (
+        rule_id INTEGER PRIMARY KEY,
+        check_id TEXT UNIQUE
+    )
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS FilePaths (
+        path_id INTEGER PRIMARY KEY,
+        slug TEXT,
+        file_path TEXT,
+        UNIQUE (slug, file_path)
+    )
+    """
+    )
+
+
+def get_rule_ids(cursor, check_ids, chunk_size=500):
+    # Returns {check_id: rule_id}, adding any rules that aren't in the table yet
+    check_ids = list(check_ids)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO Rules (check_id) VALUES (?)",
+        [(check_id,) for check_id in check_ids],
+    )
+    rule_ids = {}
+    for i in range(0, len(check_ids), chunk_size):
+        chunk = check_ids[i : i + chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            f"SELECT check_id, rule_id FROM Rules WHERE check_id IN ({placeholders})",
+            chunk,
+        )
+        rule_ids.update(cursor.fetchall())
+    return rule_ids
+
+
+def get_path_ids(cursor, paths, chunk_size=400):
+    # Returns {(slug, file_path): path_id}, adding any paths that aren't in the table yet
+    paths = list(paths)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO FilePaths (slug, file_path) VALUES (?, ?)", paths
+    )
+    path_ids = {}
+    for i in range(0, len(paths), chunk_size):
+        chunk = paths[i : i + chunk_size]
+        placeholders = ", ".join(["(?, ?)"] * len(chunk))
+        cursor.execute(
+            f"SELECT slug, file_path, path_id FROM FilePaths WHERE (slug, file_path) IN (VALUES {placeholders})",
+            [value for path in chunk for value in path],
+        )
+        path_ids.update(
+            ((slug, file_path), path_id) for slug, file_path, path_id in cursor
+        )
+    return path_ids
+
+
+def create_snippets_table(cursor):
+    # See dbutils.create_snippets_table, snippets are never compressed in SQLite
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS Snippets (
+        snippet_sha256 TEXT PRIMARY KEY,
+        compressed INTEGER,
+        content TEXT
+    )
+    """
+    )
+
+
+def insert_snippets(cursor, snippets):
+    cursor.executemany(
+        "INSERT OR IGNORE INTO Snippets (snippet_sha256, compressed, content) VALUES (?, ?, ?)",
+        snippets,
+    )
+
+
+def move_snippets_out_of_results(cursor):
+    # See dbutils.move_snippets_out_of_results, SQLite has no SHA2() so it's provided from here
+    cursor.execute("PRAGMA table_info(PluginResults)")
+    if "vuln_lines" not in {row[1] for row in cursor.fetchall()}:
+        return
+
+    print("Moving PluginResults snippets to the Snippets table, this can take a while.")
+    cursor.connection.create_function(
+        "sha256",
+        1,
+        lambda text: hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        deterministic=True,
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO Snippets (snippet_sha256, compressed, content) "
+        "SELECT sha256(vuln_lines), 0, vuln_lines FROM PluginResults WHERE vuln_lines IS NOT NULL"
+    )
+    cursor.execute(
+        "UPDATE PluginResults SET snippet_sha256 = sha256(vuln_lines) "
+        "WHERE snippet_sha256 IS NULL AND vuln_lines IS NOT NULL"
+    )
+    cursor.execute("DROP VIEW IF EXISTS LatestPluginResults")
+    cursor.execute("ALTER TABLE PluginResults DROP COLUMN vuln_lines")
+
+
+def normalize_results_table(cursor):
+    # See dbutils.normalize_results_table. The view and indexes using the old columns have to go
+    # before the columns can be dropped, they're created again afterwards.
+    cursor.execute("PRAGMA table_info(PluginResults)")
+    if "check_id" not in {row[1] for row in cursor.fetchall()}:
+        return
+
+    print("Moving PluginResults over to rule and path ids, this can take a while.")
+    cursor.execute(
+        "INSERT OR IGNORE INTO Rules (check_id) "
+        "SELECT DISTINCT check_id FROM PluginResults WHERE check_id IS NOT NULL"
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO FilePaths (slug, file_path) "
+        "SELECT DISTINCT slug, file_path FROM PluginResults WHERE file_path IS NOT NULL"
+    )
+    cursor.execute(
+        """
+    UPDATE PluginResults SET
+        rule_id = (SELECT rule_id FROM Rules WHERE Rules.check_id = PluginResults.check_id),
+        path_id = (
+            SELECT path_id FROM FilePaths
+            WHERE FilePaths.slug = PluginResults.slug AND FilePaths.file_path = PluginResults.file_path
+        )
+    WHERE rule_id IS NULL
+    """
+    )
+
+    cursor.execute("DROP VIEW IF EXISTS LatestPluginResults")
+    cursor.execute("DROP INDEX IF EXISTS idx_check_id_slug")
+    cursor.execute("DROP INDEX IF EXISTS idx_slug_file_path")
+    cursor.execute("ALTER TABLE PluginResults DROP COLUMN check_id")
+    cursor.execute("ALTER TABLE PluginResults DROP COLUMN file_path")
+
+
+def create_audit_runs_table(cursor):
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS AuditRuns (
+        run_id INTEGER PRIMARY KEY,
+        rules_hash TEXT,
+        started_at TEXT,
+        completed_at TEXT
+    )
+    """
+    )
+
+
+def create_latest_results_view(cursor):
+    # See dbutils.create_latest_results_view, IS is SQLite's NULL-safe comparison
+    cursor.execute(
+        """
+    CREATE VIEW IF NOT EXISTS LatestPluginResults AS
+    SELECT PluginResults.id, PluginResults.slug, FilePaths.file_path, Rules.check_id,
+        PluginResults.start_line, PluginResults.end_line, Snippets.content AS vuln_lines,
+        PluginResults.run_id
+    FROM PluginResults
+    JOIN Rules ON Rules.rule_id = PluginResults.rule_id
+    JOIN FilePaths ON FilePaths.path_id = PluginResults.path_id
+    LEFT JOIN Snippets ON Snippets.snippet_sha256 = PluginResults.snippet_sha256
+    LEFT JOIN PluginAudits ON PluginAudits.slug = PluginResults.slug
+    WHERE PluginAudits.run_id IS PluginResults.run_id
+    """
+    )
+
+
+def start_audit_run(cursor, rules_hash):
+    cursor.execute(
+        "INSERT INTO AuditRuns (rules_hash, started_at) VALUES (?, ?)",
+        (rules_hash, now()),
+    )
+    return cursor.lastrowid
+
+
+def complete_audit_run(cursor, run_id):
+    cursor.execute(
+        "UPDATE AuditRuns SET completed_at = ? WHERE run_id = ?", (now(), run_id)
+    )
+
+
+def forget_earlier_audits(cursor, run_id, keep=()):
+    cursor.execute(
+        "SELECT slug FROM PluginAudits WHERE run_id IS NULL OR run_id <> ?", (run_id,)
+    )
+    slugs = [(slug,) for (slug,) in cursor.fetchall() if slug not in keep]
+    cursor.executemany("DELETE FROM PluginAudits WHERE slug = ?", slugs)
+
+
+def prune_results(cursor, before_run_id, after_id=0, chunk_size=10000):
+    # Deletes one chunk of results from earlier runs that are no longer the latest for their
+    # plugin, walking the table in id order. Returns the last id looked at, or None when done.
+    cursor.execute(
+        """
+    SELECT PluginResults.id,
+        PluginAudits.run_id IS PluginResults.run_id
+    FROM PluginResults
+    LEFT JOIN PluginAudits ON PluginAudits.slug = PluginResults.slug
+    WHERE PluginResults.id > ?
+        AND (PluginResults.run_id IS NULL OR PluginResults.run_id < ?)
+    ORDER BY PluginResults.id
+    LIMIT ?
+    """,
+        (after_id, before_run_id, chunk_size),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    superseded = [(result_id,) for result_id, current in rows if not current]
+    cursor.executemany("DELETE FROM PluginResults WHERE id = ?", superseded)
+    return rows[-1][0]
+
+
+def prune_snippets(cursor, after_sha256="", chunk_size=10000):
+    cursor.execute(
+        """
+    SELECT Snippets.snippet_sha256,
+        EXISTS (
+            SELECT 1 FROM PluginResults
+            WHERE PluginResults.snippet_sha256 = Snippets.snippet_sha256
+        )
+    FROM Snippets
+    WHERE Snippets.snippet_sha256 > ?
+    ORDER BY Snippets.snippet_sha256
+    LIMIT ?
+    """,
+        (after_sha256, chunk_size),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    orphaned = [(snippet_sha256,) for snippet_sha256, used in rows if not used]
+    cursor.executemany("DELETE FROM Snippets WHERE snippet_sha256 = ?", orphaned)
+    return rows[-1][0]
+
+
+def add_missing_columns(cursor):
+    for table, column, definition in COLUMNS:
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def add_missing_indexes(cursor):
+    for table, index, columns in INDEXES:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} {columns}")
+
+
+def iter_plugin_data(cursor, chunk_size=100000):
+    # Dates come back as text from SQLite, convert them to match what MySQL returns
+    cursor.execute(
+        "SELECT slug, version, active_installs, downloaded, last_updated, added_date, download_link FROM PluginData"
+    )
+    while rows := cursor.fetchmany(chunk_size):
+        yield [
+            (
+                *row[:4],
+                datetime.fromisoformat(row[4]) if row[4] else None,
+                datetime.fromisoformat(row[5]).date() if row[5] else None,
+                row[6],
+            )
+            for row in rows
+        ]
+
+
+def iter_latest_results(cursor, chunk_size=100000):
+    cursor.execute(
+        "SELECT slug, file_path, check_id, start_line, end_line, vuln_lines FROM LatestPluginResults"
+    )
+    while rows := cursor.fetchmany(chunk_size):
+        yield rows
@@ -0,0 +1,81 @@
+import re
+import unittest
+
+import mysql.connector
+from mysql.connector.cursor import RE_SQL_INSERT_STMT
+
+import dbutils
+
+FINDING = {
+    "check_id": "php.lang.security.exec",
+    "start": {"line": 1},
+    "end": {"line": 2},
+    "extra": {"lines": "exec($_GET['x']);"},
+}
+
+
+class RecordingCursor:
+    # Keeps the statements instead of running them
+    def __init__(self):
+        self.rowcount = 1
+        self.executed = []
+        self.executed_many = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+    def executemany(self, sql, seq_params):
+        self.executed_many.append((sql, list(seq_params)))
+
+
+class BatchedInsertTest(unittest.TestCase):
+    # mysql-connector only turns executemany into one multi-row INSERT when the statement
+    # matches this, otherwise it runs an INSERT per row
+    def assertBatched(self, sql):
+        self.assertTrue(
+            re.match(RE_SQL_INSERT_STMT, sql), f"not batched by executemany: {sql}"
+        )
+
+    def test_insert_cached_findings(self):
+        cursor = RecordingCursor()
+        dbutils.insert_cached_findings(cursor, "rules", "file", [FINDING, FINDING])
+        [(sql, rows)] = cursor.executed_many
+        self.assertBatched(sql)
+        self.assertEqual(len(rows), 2)
+
+    def test_insert_results_into_db(self):
+        cursor = RecordingCursor()
+        row = dbutils.result_row("plugin", 1, 2, "0" * 64, FINDING, 3)
+        dbutils.insert_results_into_db(cursor, [row, row])
+        [(sql, rows)] = cursor.executed_many
+        self.assertBatched(sql)
+        self.assertEqual(rows, [row, row])
+        self.assertEqual(sql.count("%s"), len(row))
+
+
+class MissingTableCursor:
+    def execute(self, sql, params=None):
+        raise mysql.connector.errors.ProgrammingError(
+            msg="Table 'audit.AuditRuns' doesn't exist", errno=1146
+        )
+
+    executemany = execute
+
+
+class MissingSchemaTest(unittest.TestCase):
+    # An unmigrated database should point at --create-schema rather than fail with a traceback
+    def test_missing_tables(self):
+        calls = [
+            lambda cursor: dbutils.start_audit_run(cursor, "rules"),
+            lambda cursor: dbutils.get_rule_ids(cursor, ["rule"]),
+            lambda cursor: dbutils.get_path_ids(cursor, [("plugin", "a.php")]),
+            lambda cursor: dbutils.insert_snippets(cursor, [("0" * 64, False, "x")]),
+        ]
+        for call in calls:
+            with self.assertRaises(SystemExit) as raised:
+                call(MissingTableCursor())
+            self.assertIn("--create-schema", str(raised.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import json
+import unittest
+
+from jsonutils import JSONStreamParser, iter_array_items
+
+DOCUMENT = {
+    "version": "1.2.3",
+    "a": -2.5,
+    "b": 1e3,
+    "skipped": {"nested": [1, -0.25e-2, {"s": 'quote " and brace } in a string'}]},
+    "results": [
+        {
+            "path": "plugins/foo/a.php",
+            "check_id": "rules.sqli",
+            "start": {"line": 12, "col": -3},
+            "end": {"line": 120, "col": 4},
+            "extra": {"lines": "echo $_GET['x'];\n", "metavars": {"$X": [1, 2]}},
+        },
+        {
+            "path": "plugins/b\\u00e4r/b.php",
+            "check_id": "rules.xss",
+            "start": {"line": 0},
+            "end": {"line": 1.5e1},
+            "extra": {"lines": None, "fixed": True},
+        },
+    ],
+    "errors": [],
+    "time": 12.75,
+}
+
+FIELDS = {
+    "path": None,
+    "check_id": None,
+    "start": {"line": None},
+    "extra": {"lines": None},
+}
+
+
+class JSONStreamParserTest(unittest.TestCase):
+    def parse(self, text, read_size, key="results", fields=None):
+        return list(iter_array_items(io.StringIO(text), key, fields, read_size))
+
+    def test_chunk_sizes(self):
+        # Every read size splits numbers, strings and escapes in a different place
+        for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, indent=2)):
+            for read_size in [1, 2, 3, 5, 7, 16, 64, len(text)]:
+                with self.subTest(read_size=read_size, indent="\n" in text):
+                    self.assertEqual(self.parse(text, read_size), DOCUMENT["results"])
+
+    def test_selected_fields(self):
+        text = json.dumps(DOCUMENT)
+        expected = [
+            {
+                "path": result["path"],
+                "check_id": result["check_id"],
+                "start": {"line": result["start"]["line"]},
+                "extra": {"lines": result["extra"]["lines"]},
+            }
+            for result in DOCUMENT["results"]
+        ]
+        for read_size in [1, 4, len(text)]:
+            with self.subTest(read_size=read_size):
+                self.assertEqual(self.parse(text, read_size, fields=FIELDS), expected)
+
+    def test_number_split_before_results(self):
+        text = '{"a": -2.5, "b": 1e10, "results": [1, -2.25, 3E-2]}'
+        self.assertEqual(self.parse(text, 1), [1, -2.25, 3e-2])
+
+    def test_kept_members(self):
+        document = dict(
+            DOCUMENT,
+            errors=[
+                {"level": "warn", "path": "plugins/foo/a.php", "spans": [1, 2]},
+                {"level": "error", "message": "Invalid rule"},
+            ],
+        )
+        text = json.dumps(document)
+        for read_size in [1, 3, len(text)]:
+            with self.subTest(read_size=read_size):
+                parser = JSONStreamParser(io.StringIO(text), read_size)
+                results = list(
+                    parser.iter_array(
+                        "results",
+                        FIELDS,
+                        keep={"errors": {"level": None, "path": None}},
+                    )
+                )
+                self.assertEqual(len(results), 2)
+                self.assertEqual(
+                    parser.members,
+                    {
+                        "errors": [
+                            {"level": "warn", "path": "plugins/foo/a.php"},
+                            {"level": "error"},
+                        ]
+                    },
+                )
+
+    def test_empty_and_missing_array(self):
+        self.assertEqual(self.parse('{"results": []}', 1), [])
+        self.assertEqual(self.parse("{}", 1), [])
+        self.assertEqual(self.parse('{"other": [1, 2]}', 1), [])
+
+    def test_truncated_document(self):
+        text = json.dumps(DOCUMENT)[:-20]
+        with self.assertRaises(json.JSONDecodeError):
+            self.parse(text, 3)
+
+    def test_value_at_end_of_stream(self):
+        parser = JSONStreamParser(io.StringIO("-12.5e2"), read_size=2)
+        self.assertEqual(parser.value(), -1250.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
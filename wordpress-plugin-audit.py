@@ -4,22 +4,255 @@ import os
 import json
 import subprocess
 import zipfile
+import fnmatch
+import tempfile
 import shutil
+import hashlib
+import itertools
+import time
+import threading
+import queue
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-from io import BytesIO
 from tqdm import tqdm
-from dbutils import (
-    connect_to_db,
-    delete_results_table,
-    insert_result_into_db,
-    insert_plugin_into_db,
-)
+import dbutils
+import sqliteutils
+from httputils import create_session
+from jsonutils import JSONStreamParser
+from exportutils import export_to_parquet
 
+# The storage backend (dbutils for MySQL or sqliteutils) and the options its connect_to_db takes,
+# picked from --db when the script starts
+db = dbutils
+db_options = {}
 
-# Let's only retrieve 10 plugins per page so people feel like the status bar is actually moving
-def get_plugins(page=1, per_page=10):
-    url = f"https://api.wordpress.org/plugins/info/1.2/?action=query_plugins&request[page]={page}&request[per_page]={per_page}"
-    response = requests.get(url)
+PLUGIN_INFO_URL = "https://api.wordpress.org/plugins/info/1.2/"
+
+# The plugin info API caps the page size at 250 plugins
+MAX_PER_PAGE = 250
+
+# Archives are streamed to a temporary file, anything bigger than this is spooled to disk
+# instead of being held in memory
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+SEMGREP_REGISTRY_URL = "https://semgrep.dev/c/"
+
+# Bumped when a change to the semgrep options changes what gets stored, so audits recorded and
+# findings cached before it aren't reused
+SEMGREP_OPTIONS_VERSION = "2"
+
+# Semgrep skips files bigger than this by default, so there's no point hashing them
+SEMGREP_MAX_TARGET_BYTES = 1000000
+
+# Semgrep's default .semgrepignore, applied when it walks a plugin directory. Files passed to it
+# one by one (--file-cache and --dedupe-files) are filtered the same way before they're hashed.
+SEMGREP_IGNORED_DIRS = {
+    "node_modules",
+    "build",
+    "dist",
+    "vendor",
+    ".env",
+    ".venv",
+    ".tox",
+    ".npm",
+    ".yarn",
+    "test",
+    "tests",
+    ".semgrep",
+    ".semgrep_logs",
+}
+SEMGREP_IGNORED_FILES = ["*.min.js", "*_test.go", ".semgrep"]
+
+# Keep the command line well under ARG_MAX when passing individual files to semgrep
+SEMGREP_MAX_TARGETS_LENGTH = 512 * 1024
+
+# The parts of each semgrep result that get stored, everything else is skipped while parsing
+SEMGREP_RESULT_FIELDS = {
+    "path": None,
+    "check_id": None,
+    "start": {"line": None},
+    "end": {"line": None},
+    "extra": {"lines": None},
+}
+
+# The parts of each semgrep error that are looked at, errors without a path failed the whole run
+SEMGREP_ERROR_FIELDS = {
+    "level": None,
+    "type": None,
+    "message": None,
+    "path": None,
+}
+
+# Errors for a file that mean semgrep gave up on it. Others, like a partial parse, still come with
+# the findings for the rest of the file and are treated as a completed scan.
+SEMGREP_FILE_FAILURE_TYPES = {
+    "Timeout",
+    "Out of memory",
+    "Stack overflow",
+    "Timeout during interfile analysis",
+    "OOM during interfile analysis",
+}
+
+# Rough peak memory of a single semgrep process, used to work out how many can run at once
+SEMGREP_WORKER_MEMORY = 2 * 1024 * 1024 * 1024
+
+# Fields read by insert_plugins_into_db and download_and_extract_plugin
+PLUGIN_FIELDS = [
+    "version",
+    "active_installs",
+    "downloaded",
+    "last_updated",
+    "added",
+    "download_link",
+]
+
+# Fields returned by the API that we never store, some of these (sections/description) are
+# large chunks of HTML so turning them off makes each page a fraction of the size
+UNUSED_PLUGIN_FIELDS = [
+    "name",
+    "author",
+    "author_profile",
+    "contributors",
+    "requires",
+    "tested",
+    "requires_php",
+    "requires_plugins",
+    "compatibility",
+    "rating",
+    "ratings",
+    "num_ratings",
+    "support_threads",
+    "support_threads_resolved",
+    "homepage",
+    "donate_link",
+    "sections",
+    "description",
+    "short_description",
+    "tags",
+    "icons",
+    "banners",
+    "screenshots",
+    "versions",
+]
+
+
+class WorkerPool:
+    # Thread pool that limits how much work can be queued up and hands each finished job back
+    # to the thread that submitted it, so everything that touches the database stays on one thread.
+    # With on_item, jobs are passed an emit function to stream items back while they run, the
+    # workers block once max_items are waiting to be handled.
+    def __init__(
+        self,
+        workers,
+        on_complete,
+        max_pending=None,
+        max_weight=None,
+        on_item=None,
+        max_items=1000,
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.on_complete = on_complete
+        self.on_item = on_item
+        self.items = queue.Queue(maxsize=max_items) if on_item else None
+        self.max_pending = max_pending or workers * 2
+        self.max_weight = max_weight
+        self.pending = {}
+        self.weight = 0
+
+    def full(self, weight=0):
+        if len(self.pending) >= self.max_pending:
+            return True
+        return bool(self.max_weight) and self.weight + weight > self.max_weight
+
+    def submit(self, context, fn, *args, weight=0):
+        # Block (while handling finished jobs) until there's room in the queue, a job that is
+        # heavier than the whole budget still gets to run once the queue has drained
+        while self.pending and self.full(weight):
+            self.wait()
+
+        if self.items is not None:
+
+            def emit(item):
+                self.items.put((context, item))
+
+            future = self.executor.submit(fn, *args, emit=emit)
+        else:
+            future = self.executor.submit(fn, *args)
+        self.pending[future] = (context, weight)
+        self.weight += weight
+
+    def drain(self):
+        while True:
+            try:
+                context, item = self.items.get_nowait()
+            except queue.Empty:
+                return
+            self.on_item(context, item)
+
+    def poll(self):
+        self.wait(timeout=0)
+
+    def wait(self, timeout=None):
+        # Wait for at least one job to finish, handling streamed items in the meantime
+        while True:
+            step = timeout
+            if self.items is not None:
+                step = 0.1 if timeout is None else min(timeout, 0.1)
+            done, _ = wait(self.pending, timeout=step, return_when=FIRST_COMPLETED)
+
+            # Items are queued before their job finishes, so this picks up all of them
+            if self.items is not None:
+                self.drain()
+            if done or timeout is not None or not self.pending:
+                break
+
+        finished = [(future, self.pending.pop(future)) for future in done]
+        for future, (context, weight) in finished:
+            self.weight -= weight
+            self.on_complete(context, future.result())
+
+    def close(self):
+        while self.pending:
+            self.wait()
+        self.executor.shutdown()
+
+
+def select_backend(url):
+    # Returns the storage module and its connect_to_db options for a --db URL
+    if not url or url == "mysql":
+        return dbutils, {}
+    if url.startswith("sqlite:///"):
+        return sqliteutils, {"path": url[len("sqlite:///") :]}
+    return None, None
+
+
+def parse_last_updated(last_updated):
+    # The API uses the format 'YYYY-MM-DD HH:MMpm GMT'
+    try:
+        return datetime.strptime(last_updated, "%Y-%m-%d %I:%M%p %Z")
+    except (TypeError, ValueError):
+        return None
+
+
+def get_plugins(session, page=1, per_page=100, trim_fields=True, browse=None):
+    params = {
+        "action": "query_plugins",
+        "request[page]": page,
+        "request[per_page]": per_page,
+    }
+    if browse:
+        params["request[browse]"] = browse
+    if trim_fields:
+        for field in PLUGIN_FIELDS:
+            params[f"request[fields][{field}]"] = 1
+        for field in UNUSED_PLUGIN_FIELDS:
+            params[f"request[fields][{field}]"] = 0
+
+    response = session.get(PLUGIN_INFO_URL, params=params)
 
     if response.status_code == 200:
         return response.json()
@@ -28,37 +261,220 @@ def get_plugins(page=1, per_page=10):
         return None
 
 
-def write_plugins_to_csv_db_and_download(db_conn, cursor, download_dir, verbose=False):
+def get_plugin_pages(
+    session, first_page, total_pages, per_page, trim_fields, workers=8
+):
+    # Page 1 has already been fetched to find the page count, hand it straight back
+    yield first_page
+
+    # Fetch the remaining pages concurrently, only keeping a few pages in flight per worker
+    # so a slow consumer (database/downloads) doesn't leave the whole catalog sitting in memory
+    pages = iter(range(2, total_pages + 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(get_plugins, session, page, per_page, trim_fields)
+            for page in itertools.islice(pages, workers * 2)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Top up the queue before handing the page back to the caller
+                for page in itertools.islice(pages, 1):
+                    pending.add(
+                        executor.submit(
+                            get_plugins, session, page, per_page, trim_fields
+                        )
+                    )
+                yield future.result()
+
+
+def get_updated_plugin_pages(
+    session, first_page, total_pages, per_page, trim_fields, watermark
+):
+    # Pages are ordered by most recently updated, so walk them in order and stop as soon as we
+    # reach plugins that haven't changed since the last successful sync
+    data = first_page
+    page = 1
+    while data and "plugins" in data:
+        plugins = []
+        for plugin in data["plugins"]:
+            last_updated = parse_last_updated(plugin.get("last_updated"))
+            if last_updated and last_updated < watermark:
+                break
+            plugins.append(plugin)
+
+        yield {"info": data["info"], "plugins": plugins}
+
+        if len(plugins) < len(data["plugins"]) or page >= total_pages:
+            return
+
+        page += 1
+        data = get_plugins(session, page, per_page, trim_fields, browse="updated")
+
+    # Let the caller know the page failed so it doesn't move the watermark forward
+    yield None
+
+
+def write_plugins_to_csv_db_and_download(
+    db_conn,
+    cursor,
+    session,
+    download_dir,
+    per_page=100,
+    trim_fields=True,
+    catalog_workers=8,
+    download_workers=4,
+    incremental=False,
+    force_download=False,
+    upsert_batch_size=0,
+    verbose=False,
+    on_plugin_extracted=None,
+):
+
+    # Versions of the plugins we already have on disk, used to skip unchanged plugins
+    manifest = {} if force_download else db.get_download_manifest(cursor)
+
+    # For incremental runs only fetch the plugins updated since the previous sync
+    watermark = db.get_sync_watermark(cursor) if incremental else None
+    if incremental and not watermark:
+        print("No previous sync found, fetching the full plugin catalog.")
+    browse = "updated" if watermark else None
 
     # Get the first page to find out the total number of pages
-    data = get_plugins(page=1)
+    data = get_plugins(
+        session, page=1, per_page=per_page, trim_fields=trim_fields, browse=browse
+    )
 
     if not data or "info" not in data:
         print("Failed to retrieve the plugin information.")
         return
 
     total_pages = data["info"]["pages"]
+    total_plugins = data["info"]["results"]
 
     # Ensure the directory for plugins exists
     os.makedirs(os.path.join(download_dir, "plugins"), exist_ok=True)
 
-    # Iterate through the pages
-    for page in tqdm(range(1, total_pages + 1), desc="Downloading plugins"):
-        data = get_plugins(page=page)
+    if watermark:
+        if verbose:
+            print(f"Fetching plugins updated since {watermark}.")
+        pages = get_updated_plugin_pages(
+            session, data, total_pages, per_page, trim_fields, watermark
+        )
+        progress = tqdm(desc="Downloading updated plugins", unit="plugin")
+    else:
+        # These arrive in whatever order the requests complete
+        pages = get_plugin_pages(
+            session, data, total_pages, per_page, trim_fields, catalog_workers
+        )
+        progress = tqdm(total=total_plugins, desc="Downloading plugins", unit="plugin")
+
+    # Downloads finish out of order, record each one against the version it was queued with
+    started = time.monotonic()
+    downloaded = {"plugins": 0, "bytes": 0, "failed": 0}
+
+    def on_download_complete(plugin, result):
+        if result is False:
+            downloaded["failed"] += 1
+        if not result:
+            return
+        archive_sha256, archive_size, extracted_size = result
+        db.record_plugin_download(
+            cursor, plugin["slug"], plugin.get("version", "N/A"), archive_sha256
+        )
+        if on_plugin_extracted:
+            on_plugin_extracted(
+                plugin["slug"], plugin.get("version", "N/A"), extracted_size
+            )
+
+        downloaded["plugins"] += 1
+        downloaded["bytes"] += archive_size
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress.set_postfix(
+            downloads_per_s=f"{downloaded['plugins'] / elapsed:.1f}",
+            mb_per_s=f"{downloaded['bytes'] / elapsed / 1024 / 1024:.1f}",
+        )
 
+    downloads = WorkerPool(download_workers, on_download_complete)
+
+    # Iterate through the pages, keeping track of the most recent update we've seen
+    queued = set()
+    newest = None
+    failed_pages = 0
+    for data in pages:
         if not data or "plugins" not in data:
-            break
+            failed_pages += 1
+            continue
 
-        for plugin in data["plugins"]:
-            insert_plugin_into_db(cursor, plugin)
+        # Upsert the page with one statement per batch and commit each batch, so an interrupted
+        # run keeps the catalog data (and downloads) it has got through so far
+        batch_size = upsert_batch_size or len(data["plugins"]) or 1
+        for i in range(0, len(data["plugins"]), batch_size):
+            batch = data["plugins"][i : i + batch_size]
+            db.insert_plugins_into_db(cursor, batch)
+            db_conn.commit()
 
             if verbose:
-                print(f"Inserted data for plugin {plugin['slug']}.")
-            # Download and extract the plugin
-            download_and_extract_plugin(plugin, download_dir, verbose)
+                print(f"Inserted data for {len(batch)} plugins.")
+
+        for plugin in data["plugins"]:
+            # Download and extract the plugin, unless we already have this version or it's
+            # already queued (the catalog can shift while we're paging through it)
+            slug = plugin["slug"]
+            version = plugin.get("version", "N/A")
+            if manifest.get(slug) == version and os.path.isdir(
+                os.path.join(download_dir, "plugins", slug)
+            ):
+                if verbose:
+                    print(f"Plugin {slug} {version} already downloaded, skipping.")
+            elif slug not in queued:
+                queued.add(slug)
+                downloads.submit(
+                    plugin,
+                    download_and_extract_plugin,
+                    session,
+                    plugin,
+                    download_dir,
+                    verbose,
+                )
+            downloads.poll()
+            progress.update(1)
+
+            last_updated = parse_last_updated(plugin.get("last_updated"))
+            if last_updated and (newest is None or last_updated > newest):
+                newest = last_updated
 
+    downloads.close()
+    progress.close()
 
-def download_and_extract_plugin(plugin, download_dir, verbose):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(
+        "Downloaded {} plugins ({:.1f} MB) in {:.0f}s: {:.1f} plugins/s, {:.1f} MB/s".format(
+            downloaded["plugins"],
+            downloaded["bytes"] / 1024 / 1024,
+            elapsed,
+            downloaded["plugins"] / elapsed,
+            downloaded["bytes"] / elapsed / 1024 / 1024,
+        )
+    )
+
+    # Only move the watermark forward if we got every page and every download, otherwise the
+    # next incremental run would skip over the plugins we missed. A failed download has already
+    # removed the old copy of the plugin, so it has to be tried again.
+    if failed_pages:
+        print(
+            f"Failed to retrieve {failed_pages} catalog pages, not updating the sync watermark."
+        )
+    elif downloaded["failed"]:
+        print(
+            f"Failed to download {downloaded['failed']} plugins, not updating the sync watermark."
+        )
+    elif newest and (watermark is None or newest > watermark):
+        db.set_sync_watermark(cursor, newest)
+    db_conn.commit()
+
+
+def download_and_extract_plugin(session, plugin, download_dir, verbose):
     slug = plugin["slug"]
     download_link = plugin.get("download_link")
     last_updated = plugin.get("last_updated")
@@ -86,55 +502,973 @@ def download_and_extract_plugin(plugin, download_dir, verbose):
     try:
         if verbose:
             print(f"Downloading and extracting plugin: {slug}")
-        response = requests.get(download_link)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        with zipfile.ZipFile(BytesIO(response.content)) as z:
-            z.extractall(os.path.join(download_dir, "plugins"))
+        archive_sha256 = hashlib.sha256()
+        archive_size = 0
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as archive:
+            with session.get(download_link, stream=True) as response:
+                response.raise_for_status()  # Raises an HTTPError for bad responses
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    archive_sha256.update(chunk)
+                    archive_size += archive.write(chunk)
+
+            archive.seek(0)
+            with zipfile.ZipFile(archive) as z:
+                z.extractall(os.path.join(download_dir, "plugins"))
+                extracted_size = sum(info.file_size for info in z.infolist())
+        return archive_sha256.hexdigest(), archive_size, extracted_size
     except requests.RequestException as e:
         print(f"Failed to download {slug}: {e}")
     except zipfile.BadZipFile:
         print(f"Failed to unzip {slug}: Not a zip file or corrupt zip file")
+    # Skipped plugins return None, failed downloads are told apart from them
+    return False
 
 
-def run_semgrep_and_store_results(db_conn, cursor, download_dir, config, verbose=False):
+def get_available_memory():
+    # MemAvailable counts the page cache that can be reclaimed, which fills up while downloading.
+    # SC_AVPHYS_PAGES is only the free memory, so it's just a fallback for systems without it.
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
 
-    plugins = os.listdir(os.path.join(download_dir, "plugins"))
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
 
-    for plugin in tqdm(plugins, desc="Auditing plugins"):
-        plugin_path = os.path.join(download_dir, "plugins", plugin)
-        output_file = os.path.join(plugin_path, "semgrep_output.json")
-
-        command = [
-            "semgrep",
-            "--config",
-            "{}".format(config),
-            "--json",
-            "--no-git-ignore",
-            "--output",
-            output_file,
-            "--quiet",  # Suppress non-essential output
-            plugin_path,
+
+def size_audit_workers(workers=0, jobs=0):
+    # Split the cores between concurrent semgrep processes (workers) and semgrep's own --jobs.
+    # Lots of small single-job processes keep the cores busier than a few big ones since most
+    # plugins are too small for semgrep to parallelise well internally.
+    cpus = os.cpu_count() or 1
+    if not jobs:
+        jobs = max(1, cpus // workers) if workers else 1
+
+    if not workers:
+        workers = max(1, cpus // jobs)
+
+        # Don't start more semgrep processes than we have the memory for
+        available = get_available_memory()
+        if available:
+            workers = max(1, min(workers, available // SEMGREP_WORKER_MEMORY))
+
+    return workers, jobs
+
+
+def hash_rules(path):
+    # Hash a rules file, or every file in a rules directory
+    sha256 = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(
+            os.path.join(root, filename)
+            for root, _, filenames in os.walk(path)
+            for filename in filenames
+        )
+    else:
+        paths = [path]
+
+    for file_path in paths:
+        sha256.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def resolve_rules(session, config, cache_dir, refresh=False, verbose=False):
+    # Local rule files are used as they are
+    if os.path.exists(config):
+        return config, hash_rules(config)
+
+    # Registry configs (p/php etc) are resolved once into a local rules file named after its
+    # content hash, so every semgrep run uses the same rules and doesn't go back to the registry.
+    # The index remembers which file each config resolved to so later runs can skip the registry.
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, "index.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as file:
+            index = json.load(file)
+
+    rules_hash = index.get(config)
+    rules_path = os.path.join(cache_dir, f"{rules_hash}.yaml")
+    if rules_hash and not refresh and os.path.exists(rules_path):
+        if verbose:
+            print(f"Using cached rules for {config}: {rules_path}")
+        return rules_path, rules_hash
+
+    url = (
+        config
+        if config.startswith(("http://", "https://"))
+        else SEMGREP_REGISTRY_URL + config
+    )
+    headers = {}
+    if os.environ.get("SEMGREP_APP_TOKEN"):
+        headers["Authorization"] = f"Bearer {os.environ['SEMGREP_APP_TOKEN']}"
+    try:
+        response = session.get(url, headers=headers)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise SystemExit(f"Failed to download semgrep rules for {config}: {e}")
+
+    rules_hash = hashlib.sha256(response.content).hexdigest()
+    rules_path = os.path.join(cache_dir, f"{rules_hash}.yaml")
+    with open(rules_path, "wb") as file:
+        file.write(response.content)
+
+    index[config] = rules_hash
+    with open(index_path, "w") as file:
+        json.dump(index, file, indent=2)
+
+    if verbose:
+        print(f"Downloaded rules for {config}: {rules_path}")
+    return rules_path, rules_hash
+
+
+def get_plugin_size(plugin_path):
+    size = 0
+    files = 0
+    for root, _, filenames in os.walk(plugin_path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                continue
+            files += 1
+    return size, files
+
+
+class PluginBatcher:
+    # Groups plugins together so one semgrep run can scan many of them, a batch is handed back
+    # once it reaches the target size or file count. With no limits every plugin is its own batch.
+    def __init__(self, max_bytes=0, max_files=0):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.batch = []
+        self.size = 0
+        self.files = 0
+
+    def add(self, plugin_path):
+        if not self.max_bytes and not self.max_files:
+            return [plugin_path], 0
+
+        size, files = get_plugin_size(plugin_path)
+        self.batch.append(plugin_path)
+        self.size += size
+        self.files += files
+        if (self.max_bytes and self.size >= self.max_bytes) or (
+            self.max_files and self.files >= self.max_files
+        ):
+            return self.flush()
+        return None, 0
+
+    def flush(self):
+        batch, size = self.batch, self.size
+        self.batch = []
+        self.size = 0
+        self.files = 0
+        return batch or None, size
+
+
+def describe_targets(targets):
+    return ", ".join(os.path.basename(os.path.normpath(target)) for target in targets)
+
+
+class SemgrepError(Exception):
+    pass
+
+
+def file_scan_failed(error):
+    # The type is a name, or a list starting with it for PartialParsing
+    error_type = error.get("type")
+    if isinstance(error_type, list):
+        error_type = error_type[0] if error_type else None
+    return error.get("level") == "error" or error_type in SEMGREP_FILE_FAILURE_TYPES
+
+
+def iter_semgrep_results(targets, config, jobs=1, failed_paths=None):
+    command = [
+        "semgrep",
+        "--config",
+        "{}".format(config),
+        "--json",
+        "--no-git-ignore",
+        # Keep the rule ids as they are in the registry, semgrep prefixes the ids of rules read
+        # from a local file with its directory, and the rules are always read from one here
+        "--no-rewrite-rule-ids",
+        # Semgrep scans files passed to it explicitly whatever their extension, skip the ones
+        # it would have left out when walking a directory
+        "--skip-unknown-extensions",
+        "--jobs",
+        str(jobs),
+        "--quiet",  # Suppress non-essential output
+        *targets,
+    ]
+
+    # Parse the results straight from semgrep's stdout as they're written, rather than writing
+    # the whole document out to a file and loading it back in
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, text=True, encoding="utf-8"
+    )
+    parser = JSONStreamParser(process.stdout)
+    completed = False
+    try:
+        yield from parser.iter_array(
+            "results", SEMGREP_RESULT_FIELDS, keep={"errors": SEMGREP_ERROR_FIELDS}
+        )
+        process.stdout.read()
+        completed = True
+    finally:
+        if not completed:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+
+    # Semgrep exits with 2 or more when the scan itself failed (bad rules, out of memory etc), the
+    # results are then incomplete and the plugins mustn't be recorded as audited
+    errors = parser.members.get("errors") or []
+    fatal = [
+        error
+        for error in errors
+        if error.get("level") == "error" and not error.get("path")
+    ]
+    if returncode >= 2 or fatal:
+        message = fatal[0].get("message") if fatal else None
+        raise SemgrepError(f"semgrep exited with status {returncode}: {message}")
+    if returncode != 0:
+        print(
+            f"Semgrep exited with status {returncode} for {describe_targets(targets)}"
+        )
+
+    # Files that timed out or ran out of memory weren't analysed
+    if failed_paths is not None:
+        failed_paths.update(
+            os.path.normpath(error["path"])
+            for error in errors
+            if error.get("path") and file_scan_failed(error)
+        )
+
+
+def scan_plugins(plugin_paths, config, jobs=1, verbose=False, emit=None):
+    # Scan the whole batch with a single semgrep run so the startup cost (rule parsing etc) is
+    # shared, then work out which plugin each result belongs to from its path
+    plugins_dir = os.path.dirname(plugin_paths[0])
+    plugins = {os.path.basename(plugin_path) for plugin_path in plugin_paths}
+
+    try:
+        for item in iter_semgrep_results(plugin_paths, config, jobs):
+            item["path"] = os.path.normpath(item["path"])
+            plugin = os.path.relpath(item["path"], plugins_dir).split(os.sep)[0]
+            if plugin in plugins:
+                emit((plugin, item))
+    except (json.JSONDecodeError, SemgrepError) as e:
+        print(f"Failed to scan {describe_targets(plugin_paths)}: {e}")
+        return set(), {}
+
+    if verbose:
+        print(f"Semgrep analysis completed for {describe_targets(plugin_paths)}.")
+    return plugins, {}
+
+
+# Worker threads look up the file cache through their own database connection
+thread_local = threading.local()
+
+
+def get_reader_cursor():
+    if not hasattr(thread_local, "cursor"):
+        # Autocommit so every lookup sees what the main thread has written since
+        db_conn, cursor = db.connect_to_db(autocommit=True, **db_options)
+        thread_local.cursor = cursor
+    return thread_local.cursor
+
+
+def prune_superseded_results(before_run_id, chunk_size=10000):
+    # Runs on its own connection in small autocommitted chunks, so neither readers nor the audit
+    # writer are held up behind one huge DELETE
+    db_conn, cursor = db.connect_to_db(autocommit=True, **db_options)
+    after_id = 0
+    while after_id is not None:
+        after_id = db.prune_results(cursor, before_run_id, after_id, chunk_size)
+    cursor.close()
+    db_conn.close()
+
+
+def prune_orphaned_snippets(chunk_size=10000):
+    # Snippets are shared between results, so they can only go once nothing points at them. This
+    # runs after the audit writer is done, a snippet it skipped as already stored could otherwise
+    # be removed before its results are committed.
+    db_conn, cursor = db.connect_to_db(autocommit=True, **db_options)
+    after_sha256 = ""
+    while after_sha256 is not None:
+        after_sha256 = db.prune_snippets(cursor, after_sha256, chunk_size)
+    cursor.close()
+    db_conn.close()
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def chunk_targets(targets):
+    chunk = []
+    length = 0
+    for target in targets:
+        if chunk and length + len(target) > SEMGREP_MAX_TARGETS_LENGTH:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(target)
+        length += len(target) + 1
+    if chunk:
+        yield chunk
+
+
+def index_plugin_files(plugin_path):
+    # Hash every file semgrep would look at
+    files = []
+    for root, dirnames, filenames in os.walk(plugin_path):
+        dirnames[:] = [name for name in dirnames if name not in SEMGREP_IGNORED_DIRS]
+        for filename in filenames:
+            if any(
+                fnmatch.fnmatch(filename, pattern) for pattern in SEMGREP_IGNORED_FILES
+            ):
+                continue
+            # Normalized the way semgrep reports paths (no leading ./ etc), so results stored
+            # from these paths look the same as the ones from a directory scan
+            path = os.path.normpath(os.path.join(root, filename))
+            try:
+                if os.path.getsize(path) > SEMGREP_MAX_TARGET_BYTES:
+                    continue
+                files.append((path, hash_file(path)))
+            except OSError:
+                continue
+    return files
+
+
+def scan_files(paths, config, jobs=1):
+    # Scan individual files, returning the findings (minus the path) for each of them, and the
+    # files semgrep reported errors for
+    findings = {os.path.normpath(path): [] for path in paths}
+    failed = set()
+    for chunk in chunk_targets(paths):
+        for item in iter_semgrep_results(chunk, config, jobs, failed):
+            file_findings = findings.get(os.path.normpath(item["path"]))
+            if file_findings is not None:
+                del item["path"]
+                file_findings.append(item)
+    return findings, failed
+
+
+def scan_plugins_cached(
+    plugin_paths, config, jobs, rules_hash, verbose=False, emit=None
+):
+    files = [
+        (os.path.basename(plugin_path), path, file_hash)
+        for plugin_path in plugin_paths
+        for path, file_hash in index_plugin_files(plugin_path)
+    ]
+
+    # Only files we haven't seen before with these rules get scanned, once per unique hash
+    cached = db.get_cached_findings(
+        get_reader_cursor(), rules_hash, {file_hash for _, _, file_hash in files}
+    )
+    targets = {}
+    for _, path, file_hash in files:
+        if file_hash not in cached:
+            targets.setdefault(file_hash, path)
+
+    try:
+        scanned, failed = scan_files(list(targets.values()), config, jobs)
+    except (json.JSONDecodeError, SemgrepError) as e:
+        print(f"Failed to scan {describe_targets(plugin_paths)}: {e}")
+        return set(), {}
+
+    # Files with errors aren't cached, and plugins containing them don't count as audited
+    new_findings = {
+        file_hash: scanned[os.path.normpath(path)]
+        for file_hash, path in targets.items()
+        if os.path.normpath(path) not in failed
+    }
+    incomplete = {
+        plugin
+        for plugin, _, file_hash in files
+        if file_hash not in cached and file_hash not in new_findings
+    }
+    if incomplete:
+        print(f"Some files in {', '.join(sorted(incomplete))} failed to scan.")
+
+    if verbose:
+        print(
+            f"Semgrep analysis completed for {describe_targets(plugin_paths)}, "
+            f"{len(targets)} of {len(files)} files scanned."
+        )
+
+    # Replay the findings for every file, whether they came from the cache or this scan
+    for plugin, path, file_hash in files:
+        if plugin in incomplete:
+            continue
+        for finding in cached.get(file_hash, new_findings.get(file_hash, [])):
+            emit((plugin, dict(finding, path=path)))
+    completed = {os.path.basename(plugin_path) for plugin_path in plugin_paths}
+    return completed - incomplete, new_findings
+
+
+def scan_unique_files(targets, config, jobs=1):
+    # Scan one copy of each file, returning the findings keyed on the file hash
+    try:
+        scanned, failed = scan_files(list(targets.values()), config, jobs)
+    except (json.JSONDecodeError, SemgrepError) as e:
+        print(f"Failed to scan {len(targets)} files: {e}")
+        return {}
+
+    # Files with errors are left out, so they aren't cached and their plugins get skipped
+    return {
+        file_hash: scanned[os.path.normpath(path)]
+        for file_hash, path in targets.items()
+        if os.path.normpath(path) not in failed
+    }
+
+
+def audit_plugins(
+    plugin_paths, config, jobs, rules_hash, file_cache, verbose=False, emit=None
+):
+    if file_cache:
+        return scan_plugins_cached(
+            plugin_paths, config, jobs, rules_hash, verbose, emit=emit
+        )
+    return scan_plugins(plugin_paths, config, jobs, verbose, emit=emit)
+
+
+def needs_audit(plugin, versions, ledger, rules_hash):
+    # Plugins are only audited again when the version on disk or the rules have changed
+    version = versions.get(plugin)
+    return version is None or ledger.get(plugin) != (version, rules_hash)
+
+
+# Snippets shorter than this don't get any smaller by compressing them
+COMPRESS_MIN_BYTES = 64
+
+
+def compress_snippet(text):
+    # Same format as MySQL's COMPRESS(), the length of the text followed by its zlib stream, so
+    # UNCOMPRESS() can read it back in the LatestPluginResults view
+    data = text.encode("utf-8")
+    return struct.pack("<I", len(data)) + zlib.compress(data)
+
+
+class ResultWriter:
+    # Buffers result rows and writes them with multi-row INSERTs, instead of a round trip and a
+    # commit for every row. Commits happen once per audit job, or every commit_rows rows if set.
+    def __init__(
+        self,
+        db_conn,
+        cursor,
+        run_id,
+        batch_size=1000,
+        commit_rows=0,
+        compress_snippets=False,
+        snippet_cache_size=100000,
+    ):
+        self.db_conn = db_conn
+        self.cursor = cursor
+        self.run_id = run_id
+        self.batch_size = max(batch_size, 1)
+        self.commit_rows = commit_rows
+        self.rows = []
+        self.uncommitted = 0
+
+        # Plugins whose scan failed this run, their earlier audits are kept
+        self.failed = set()
+
+        # Rules and file paths are stored by id, these save looking the same ones up again. Paths
+        # belong to a plugin so they're only kept until the plugin's results are committed.
+        self.rule_ids = {}
+        self.path_ids = {}
+
+        # Snippets are stored once, keyed by their hash. The most recently seen hashes are kept
+        # so the same snippet isn't sent again, one that has been evicted is ignored by the insert.
+        self.compress_snippets = compress_snippets
+        self.snippet_cache_size = max(snippet_cache_size, 0)
+        self.known_snippets = OrderedDict()
+        self.new_snippets = []
+
+    def add(self, plugin, result):
+        self.rows.append((plugin, result))
+        if len(self.rows) >= self.batch_size:
+            self.write()
+            if self.commit_rows and self.uncommitted >= self.commit_rows:
+                self.commit()
+
+    def resolve(self):
+        # Returns the buffered results as rows for the database, with rule and path ids
+        check_ids = {result["check_id"] for _, result in self.rows}
+        check_ids.difference_update(self.rule_ids)
+        if check_ids:
+            self.rule_ids.update(db.get_rule_ids(self.cursor, check_ids))
+
+        paths = {(plugin, result["path"]) for plugin, result in self.rows}
+        paths.difference_update(self.path_ids)
+        if paths:
+            self.path_ids.update(db.get_path_ids(self.cursor, paths))
+
+        hashes = [
+            self.store_snippet(result["extra"]["lines"]) for _, result in self.rows
         ]
+        if self.new_snippets:
+            db.insert_snippets(self.cursor, self.new_snippets)
+            self.new_snippets = []
 
-        try:
-            # Run the semgrep command
-            subprocess.run(command, check=True)
-            if verbose:
-                print(f"Semgrep analysis completed for {plugin}.")
+        rows = [
+            db.result_row(
+                plugin,
+                self.path_ids[(plugin, result["path"])],
+                self.rule_ids[result["check_id"]],
+                snippet_sha256,
+                result,
+                self.run_id,
+            )
+            for (plugin, result), snippet_sha256 in zip(self.rows, hashes)
+        ]
+        self.rows = []
+        return rows
+
+    def store_snippet(self, text):
+        # Returns the snippet's hash, queueing it up for insertion unless it was seen recently
+        if text is None:
+            return None
+        snippet_sha256 = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if snippet_sha256 in self.known_snippets:
+            self.known_snippets.move_to_end(snippet_sha256)
+            return snippet_sha256
+
+        if self.compress_snippets and len(text) >= COMPRESS_MIN_BYTES:
+            self.new_snippets.append((snippet_sha256, True, compress_snippet(text)))
+        else:
+            self.new_snippets.append((snippet_sha256, False, text))
+
+        self.known_snippets[snippet_sha256] = None
+        if len(self.known_snippets) > self.snippet_cache_size:
+            self.known_snippets.popitem(last=False)
+        return snippet_sha256
+
+    def write(self):
+        if self.rows:
+            rows = self.resolve()
+            db.insert_results_into_db(self.cursor, rows)
+            self.uncommitted += len(rows)
+
+    def discard(self, plugin):
+        self.failed.add(plugin)
+        self.write()
+        db.delete_plugin_results(self.cursor, plugin, self.run_id)
+
+    def record_audit(self, plugin, version, rules_hash):
+        db.record_plugin_audit(self.cursor, plugin, version, rules_hash, self.run_id)
+
+    def commit(self):
+        self.write()
+        self.db_conn.commit()
+        self.uncommitted = 0
+        self.path_ids = {}
+
+    def close(self):
+        self.commit()
+
+
+def escape_tsv(value):
+    # The escaping LOAD DATA expects with its default FIELDS ESCAPED BY '\\'
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\0", "\\0")
+    )
+
+
+class BulkResultWriter(ResultWriter):
+    # Spools results to a local tab separated file and loads it with LOAD DATA LOCAL INFILE every
+    # chunk_rows rows, for full rescans where even multi-row INSERTs are too slow. Removing the
+    # results of failed scans and recording the audit ledger wait until the results they refer
+    # to have been loaded.
+    def __init__(
+        self,
+        db_conn,
+        cursor,
+        run_id,
+        chunk_rows=100000,
+        spool_dir=None,
+        compress_snippets=False,
+        snippet_cache_size=100000,
+    ):
+        super().__init__(
+            db_conn,
+            cursor,
+            run_id,
+            compress_snippets=compress_snippets,
+            snippet_cache_size=snippet_cache_size,
+        )
+        self.chunk_rows = max(chunk_rows, 1)
+        self.spool_dir = spool_dir
+        self.spool = None
+        self.spooled = 0
+        self.discarded = set()
+        self.audits = []
+
+    def write(self):
+        if not self.rows:
+            return
+        if self.spool is None:
+            self.spool = tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8",
+                newline="",
+                suffix=".tsv",
+                dir=self.spool_dir,
+                delete=False,
+            )
+        for row in self.resolve():
+            self.spool.write("\t".join(map(escape_tsv, row)) + "\n")
+            self.spooled += 1
+
+    def discard(self, plugin):
+        self.failed.add(plugin)
+        self.discarded.add(plugin)
+
+    def record_audit(self, plugin, version, rules_hash):
+        self.audits.append((plugin, version, rules_hash))
 
-        except subprocess.CalledProcessError as e:
-            print(f"Semgrep failed for {plugin}: {e}")
-        except json.JSONDecodeError as e:
-            print(f"Failed to decode JSON for {plugin}: {e}")
-        except Exception as e:
-            print(f"Unexpected error for {plugin}: {e}")
+    def commit(self):
+        self.write()
+        if self.spooled >= self.chunk_rows:
+            self.load()
+        else:
+            self.db_conn.commit()
+        self.path_ids = {}
 
-        # Read the output file and process results
-        with open(output_file, "r") as file:
-            data = json.load(file)
-            for item in data["results"]:
-                insert_result_into_db(cursor, plugin, item)
-                db_conn.commit()
+    def load(self):
+        self.write()
+        if self.spool is not None:
+            self.spool.close()
+            try:
+                db.load_results_into_db(self.cursor, self.spool.name)
+            finally:
+                os.remove(self.spool.name)
+            self.spool = None
+            self.spooled = 0
+
+        for plugin in self.discarded:
+            db.delete_plugin_results(self.cursor, plugin, self.run_id)
+        for audit in self.audits:
+            db.record_plugin_audit(self.cursor, *audit, self.run_id)
+        self.discarded = set()
+        self.audits = []
+        self.db_conn.commit()
+
+    def close(self):
+        self.load()
+
+
+def store_plugin_results(writer, plugin, results, version, rules_hash):
+    for item in results:
+        writer.add(plugin, item)
+
+    # Recording the audit switches the plugin over to these results, the earlier ones get pruned
+    writer.record_audit(plugin, version, rules_hash)
+    writer.commit()
+
+
+def finish_audit(writer, cursor, plugin_paths, audit, versions, rules_hash):
+    completed, new_findings = audit
+    for file_hash, findings in new_findings.items():
+        db.insert_cached_findings(cursor, rules_hash, file_hash, findings)
+
+    for plugin in map(os.path.basename, plugin_paths):
+        if plugin not in completed:
+            # Don't leave the partial results of a failed scan behind
+            writer.discard(plugin)
+        else:
+            writer.record_audit(plugin, versions.get(plugin), rules_hash)
+    writer.commit()
+
+
+def run_deduplicated_audit(
+    writer,
+    cursor,
+    plugin_paths,
+    config,
+    workers,
+    jobs,
+    rules_hash,
+    versions,
+    files_per_job=500,
+    verbose=False,
+):
+    # Index every file in the corpus by content hash, lots of plugins bundle identical copies of
+    # the same libraries so there are far fewer unique files than files
+    index = {}
+    unique = {}
+
+    def on_indexed(plugin_path, files):
+        index[os.path.basename(plugin_path)] = files
+        for path, file_hash in files:
+            unique.setdefault(file_hash, path)
+        progress.update(1)
+
+    progress = tqdm(total=len(plugin_paths), desc="Indexing plugins")
+    indexer = WorkerPool(workers, on_indexed)
+    for plugin_path in plugin_paths:
+        indexer.submit(plugin_path, index_plugin_files, plugin_path)
+    indexer.close()
+    progress.close()
+
+    # Scan each unique file once, skipping anything already in the cache
+    cached = db.get_cached_file_hashes(cursor, rules_hash, unique)
+    uncached = [
+        (file_hash, path)
+        for file_hash, path in unique.items()
+        if file_hash not in cached
+    ]
+    if verbose:
+        print(
+            f"{len(unique)} unique files out of {sum(map(len, index.values()))}, {len(uncached)} need scanning."
+        )
+
+    def on_scanned(targets, findings):
+        for file_hash, file_findings in findings.items():
+            db.insert_cached_findings(cursor, rules_hash, file_hash, file_findings)
+        writer.commit()
+        progress.update(len(targets))
+
+    progress = tqdm(total=len(uncached), desc="Auditing unique files", unit="file")
+    scanner = WorkerPool(workers, on_scanned)
+    for i in range(0, len(uncached), files_per_job):
+        targets = dict(uncached[i : i + files_per_job])
+        scanner.submit(targets, scan_unique_files, targets, config, jobs)
+    scanner.close()
+    progress.close()
+
+    # Fan the findings out to every plugin and path that contains each file
+    for plugin, files in tqdm(index.items(), desc="Storing results"):
+        findings = db.get_cached_findings(
+            cursor, rules_hash, {file_hash for _, file_hash in files}
+        )
+        if any(file_hash not in findings for _, file_hash in files):
+            print(f"Some files in {plugin} failed to scan, skipping.")
+            writer.discard(plugin)
+            continue
+        results = [
+            dict(finding, path=path)
+            for path, file_hash in files
+            for finding in findings[file_hash]
+        ]
+        store_plugin_results(writer, plugin, results, versions.get(plugin), rules_hash)
+
+
+def run_semgrep_and_store_results(
+    db_conn,
+    cursor,
+    writer,
+    download_dir,
+    config,
+    workers=1,
+    jobs=1,
+    batch_bytes=0,
+    batch_files=0,
+    rules_hash=None,
+    force=False,
+    file_cache=False,
+    dedupe=False,
+    verbose=False,
+    skip=(),
+):
+
+    # Skip plugins that have already been audited at the same version with the same rules
+    versions = db.get_download_manifest(cursor)
+    ledger = {} if force else db.get_audit_ledger(cursor)
+    plugins = [
+        plugin
+        for plugin in os.listdir(os.path.join(download_dir, "plugins"))
+        if plugin not in skip and needs_audit(plugin, versions, ledger, rules_hash)
+    ]
+
+    if dedupe:
+        plugin_paths = [
+            os.path.join(download_dir, "plugins", plugin) for plugin in plugins
+        ]
+        run_deduplicated_audit(
+            writer,
+            cursor,
+            plugin_paths,
+            config,
+            workers,
+            jobs,
+            rules_hash,
+            versions,
+            batch_files or 500,
+            verbose,
+        )
+        return
+
+    progress = tqdm(total=len(plugins), desc="Auditing plugins")
+
+    # Semgrep runs in the worker threads and results are streamed back to this thread as they're
+    # parsed, so there's only ever one writer on the database connection
+    def on_result(batch, item):
+        writer.add(*item)
+
+    def on_audit_complete(batch, audit):
+        finish_audit(writer, cursor, batch, audit, versions, rules_hash)
+        progress.update(len(batch))
+
+    audits = WorkerPool(workers, on_audit_complete, on_item=on_result)
+    batcher = PluginBatcher(batch_bytes, batch_files)
+    for plugin in plugins:
+        plugin_path = os.path.join(download_dir, "plugins", plugin)
+        batch, _ = batcher.add(plugin_path)
+        if batch:
+            audits.submit(
+                batch,
+                audit_plugins,
+                batch,
+                config,
+                jobs,
+                rules_hash,
+                file_cache,
+                verbose,
+            )
+
+    batch, _ = batcher.flush()
+    if batch:
+        audits.submit(
+            batch, audit_plugins, batch, config, jobs, rules_hash, file_cache, verbose
+        )
+    audits.close()
+    progress.close()
+
+
+def download_and_audit_plugins(
+    db_conn,
+    cursor,
+    writer,
+    session,
+    download_dir,
+    config,
+    audit_workers=1,
+    semgrep_jobs=1,
+    batch_bytes=0,
+    batch_files=0,
+    rules_hash=None,
+    force_audit=False,
+    file_cache=False,
+    dedupe=False,
+    queue_size=8,
+    queue_bytes=None,
+    verbose=False,
+    **download_options,
+):
+    audited = set()
+    audit_progress = tqdm(desc="Auditing plugins", unit="plugin", position=1)
+    versions = db.get_download_manifest(cursor)
+    ledger = {} if force_audit else db.get_audit_ledger(cursor)
+
+    def on_result(batch, item):
+        writer.add(*item)
+
+    def on_audit_complete(batch, audit):
+        finish_audit(writer, cursor, batch, audit, versions, rules_hash)
+        audited.update(os.path.basename(plugin_path) for plugin_path in batch)
+        audit_progress.update(len(batch))
+
+    # Plugins are queued for auditing as soon as they're extracted. When the queue is full (or
+    # the extracted plugins waiting in it go over the disk budget) queueing blocks, which stops
+    # the download loop from starting new downloads until semgrep catches up.
+    audits = WorkerPool(
+        audit_workers,
+        on_audit_complete,
+        max_pending=audit_workers + queue_size,
+        max_weight=queue_bytes,
+        on_item=on_result,
+    )
+    batcher = PluginBatcher(batch_bytes, batch_files)
+
+    def on_plugin_extracted(plugin, version, extracted_size):
+        versions[plugin] = version
+        if not needs_audit(plugin, versions, ledger, rules_hash):
+            return
+
+        plugin_path = os.path.join(download_dir, "plugins", plugin)
+        audits.poll()
+        batch, batch_size = batcher.add(plugin_path)
+        if batch:
+            audits.submit(
+                batch,
+                audit_plugins,
+                batch,
+                config,
+                semgrep_jobs,
+                rules_hash,
+                file_cache,
+                verbose,
+                weight=batch_size or extracted_size,
+            )
+
+    write_plugins_to_csv_db_and_download(
+        db_conn,
+        cursor,
+        session,
+        download_dir,
+        verbose=verbose,
+        on_plugin_extracted=on_plugin_extracted,
+        **download_options,
+    )
+
+    batch, batch_size = batcher.flush()
+    if batch:
+        audits.submit(
+            batch,
+            audit_plugins,
+            batch,
+            config,
+            semgrep_jobs,
+            rules_hash,
+            file_cache,
+            verbose,
+            weight=batch_size,
+        )
+    audits.close()
+    audit_progress.close()
+
+    # Plugins that were already up to date weren't downloaded, audit those now
+    run_semgrep_and_store_results(
+        db_conn,
+        cursor,
+        writer,
+        download_dir,
+        config,
+        audit_workers,
+        semgrep_jobs,
+        batch_bytes,
+        batch_files,
+        rules_hash,
+        force_audit,
+        file_cache,
+        dedupe,
+        verbose,
+        skip=audited,
+    )
 
 
 if __name__ == "__main__":
@@ -144,7 +1478,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--download",
         action="store_true",
-        help="Download and extract plugins, if plugin directory already exists, it will delete it and redownload",
+        help="Download and extract plugins, plugins already downloaded at the latest version are skipped, otherwise the plugin directory is deleted and redownloaded",
+    )
+    parser.add_argument(
+        "--force-download",
+        action="store_true",
+        help="Redownload every plugin, even if the downloaded version is already the latest",
     )
     parser.add_argument(
         "--download-dir",
@@ -155,7 +1494,34 @@ if __name__ == "__main__":
     parser.add_argument(
         "--audit",
         action="store_true",
-        help="Audits downloaded plugins sequentially",
+        help="Audits downloaded plugins",
+    )
+    parser.add_argument(
+        "--force-audit",
+        action="store_true",
+        help="Audit every plugin, even if it was already audited at the same version with the same rules",
+    )
+    parser.add_argument(
+        "--file-cache",
+        action="store_true",
+        help="Cache semgrep findings by file content hash and only scan files that haven't been scanned with the same rules before",
+    )
+    parser.add_argument(
+        "--dedupe-files",
+        action="store_true",
+        help="Index every file across all plugins by content hash, scan each unique file once and copy its findings to every plugin that contains it (implies --file-cache)",
+    )
+    parser.add_argument(
+        "--audit-workers",
+        type=int,
+        default=0,
+        help="Number of plugins to audit concurrently, 0 to size from the CPU count and available memory (default: 0)",
+    )
+    parser.add_argument(
+        "--semgrep-jobs",
+        type=int,
+        default=0,
+        help="Number of jobs each semgrep process runs with (semgrep --jobs), 0 to split the CPUs between --audit-workers (default: 0)",
     )
     parser.add_argument(
         "--config",
@@ -163,6 +1529,34 @@ if __name__ == "__main__":
         default="p/php",
         help="Semgrep config/rules to run - https://semgrep.dev/docs/running-rules#running-semgrep-registry-rules-locally (default: p/php)",
     )
+    parser.add_argument(
+        "--rules-cache-dir",
+        type=str,
+        help="Directory to cache the resolved --config rules in, so later runs don't need to access the semgrep registry (default: a temporary directory for this run)",
+    )
+    parser.add_argument(
+        "--refresh-rules",
+        action="store_true",
+        help="Download the --config rules again even if they're in --rules-cache-dir",
+    )
+    parser.add_argument(
+        "--export-parquet",
+        type=str,
+        metavar="DIR",
+        help="Export PluginData and the latest PluginResults to Parquet files in this directory, with the results partitioned by check_id (needs pyarrow)",
+    )
+    parser.add_argument(
+        "--export-chunk-size",
+        type=int,
+        default=100000,
+        help="Number of rows to read from the database at a time when exporting (default: 100000)",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="mysql",
+        help="Where to store the results, mysql for the server in config.ini or sqlite:///path for a local SQLite database (default: mysql)",
+    )
     parser.add_argument(
         "--create-schema",
         action="store_true",
@@ -171,7 +1565,120 @@ if __name__ == "__main__":
     parser.add_argument(
         "--clear-results",
         action="store_true",
-        help="Clear audit table and then run, useful if run as a cron job and we only care about the latest release",
+        help="Audit every plugin again and then remove the results of plugins that weren't audited, useful if run as a cron job and we only care about the latest release. Earlier results stay visible until they're replaced.",
+    )
+    parser.add_argument(
+        "--prune-chunk-size",
+        type=int,
+        default=10000,
+        help="Number of results (and snippets) to check per DELETE when pruning the results of earlier runs (default: 10000)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only download plugins updated since the last successful --download run",
+    )
+    parser.add_argument(
+        "--per-page",
+        type=int,
+        default=100,
+        help=f"Number of plugins to request per catalog page, up to {MAX_PER_PAGE} (default: 100)",
+    )
+    parser.add_argument(
+        "--all-fields",
+        action="store_true",
+        help="Request the full plugin field set from the API instead of only the fields that are stored",
+    )
+    parser.add_argument(
+        "--catalog-workers",
+        type=int,
+        default=8,
+        help="Number of plugin catalog pages to fetch concurrently (default: 8)",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=4,
+        help="Number of plugins to download and extract concurrently (default: 4)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help="Maximum number of keep-alive HTTP connections per host (default: the larger of --catalog-workers and --download-workers)",
+    )
+    parser.add_argument(
+        "--upsert-batch-size",
+        type=int,
+        default=0,
+        help="Number of plugins to write to the database with each multi-row upsert, 0 for one upsert per catalog page (default: 0)",
+    )
+    parser.add_argument(
+        "--batch-mb",
+        type=int,
+        default=0,
+        help="Scan several plugins with one semgrep run, starting a new run once a batch reaches this many MB, 0 to disable (default: 0)",
+    )
+    parser.add_argument(
+        "--batch-files",
+        type=int,
+        default=0,
+        help="Scan several plugins with one semgrep run, starting a new run once a batch reaches this many files, 0 to disable (default: 0)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="With --download and --audit, audit each plugin as soon as it has been extracted instead of waiting for every download to finish",
+    )
+    parser.add_argument(
+        "--audit-queue-size",
+        type=int,
+        default=8,
+        help="Number of extracted plugins that can wait for auditing before downloads are paused in --pipeline mode (default: 8)",
+    )
+    parser.add_argument(
+        "--audit-queue-mb",
+        type=int,
+        default=2048,
+        help="Size of extracted plugins (in MB) that can wait for auditing before downloads are paused in --pipeline mode, 0 for no limit (default: 2048)",
+    )
+    parser.add_argument(
+        "--insert-batch-size",
+        type=int,
+        default=1000,
+        help="Number of audit results to write to the database with each multi-row INSERT (default: 1000)",
+    )
+    parser.add_argument(
+        "--commit-rows",
+        type=int,
+        default=0,
+        help="Commit audit results every this many rows as well as after each audit, 0 to only commit after each audit (default: 0)",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Spool audit results to a local file and load them with LOAD DATA LOCAL INFILE instead of INSERTs, for full rescans (needs local_infile enabled on the server)",
+    )
+    parser.add_argument(
+        "--bulk-load-rows",
+        type=int,
+        default=100000,
+        help="Number of audit results to spool before each load in --bulk-load mode (default: 100000)",
+    )
+    parser.add_argument(
+        "--spool-dir",
+        type=str,
+        help="Directory to spool audit results in for --bulk-load (default: the system temporary directory)",
+    )
+    parser.add_argument(
+        "--compress-snippets",
+        action="store_true",
+        help="Store the code snippets of audit results zlib compressed, MySQL only (they are read back uncompressed from LatestPluginResults)",
+    )
+    parser.add_argument(
+        "--snippet-cache-size",
+        type=int,
+        default=100000,
+        help="Number of recently stored snippet hashes to remember, so the same snippet isn't written again (default: 100000)",
     )
     parser.add_argument(
         "--verbose", action="store_true", help="Print detailed messages"
@@ -180,25 +1687,180 @@ if __name__ == "__main__":
     # Parse arguments
     args = parser.parse_args()
 
-    if not args.download and not args.audit:
-        print("Please set either the --download or --audit option.\n")
+    if not 1 <= args.per_page <= MAX_PER_PAGE:
+        parser.error(f"--per-page must be between 1 and {MAX_PER_PAGE}")
+
+    if args.incremental and not args.download:
+        parser.error("--incremental can only be used with --download")
+
+    if args.clear_results and not args.audit:
+        parser.error("--clear-results can only be used with --audit")
+
+    db, db_options = select_backend(args.db)
+    if not db:
+        parser.error("--db must be mysql or sqlite:///path")
+    if args.bulk_load:
+        if db is not dbutils:
+            parser.error("--bulk-load is only supported with MySQL")
+        db_options["allow_local_infile"] = True
+    if args.compress_snippets and db is not dbutils:
+        parser.error("--compress-snippets is only supported with MySQL")
+
+    if not args.download and not args.audit and not args.export_parquet:
+        print("Please set either the --download, --audit or --export-parquet option.\n")
         parser.print_help()
 
     else:
         # Create schema
-        db_conn, cursor = connect_to_db(args.create_schema)
-        if args.clear_results:
-            delete_results_table(cursor)
+        db_conn, cursor = db.connect_to_db(args.create_schema, **db_options)
+
+        audit_workers, semgrep_jobs = size_audit_workers(
+            args.audit_workers, args.semgrep_jobs
+        )
+        if args.audit and args.verbose:
+            print(
+                f"Auditing with {audit_workers} workers, {semgrep_jobs} semgrep jobs each."
+            )
+
+        # One pooled session is shared by everything that goes over the network for the whole run
+        session = create_session(
+            args.pool_size or max(args.catalog_workers, args.download_workers)
+        )
+
+        # Pin the rules for the whole run
+        if args.audit:
+            rules_cache_dir = args.rules_cache_dir
+            if not rules_cache_dir:
+                temporary_rules_dir = tempfile.TemporaryDirectory()
+                rules_cache_dir = temporary_rules_dir.name
+            rules, rules_hash = resolve_rules(
+                session, args.config, rules_cache_dir, args.refresh_rules, args.verbose
+            )
+            # Audits and cached findings are keyed on the rules and the options they're run with
+            rules_hash = hashlib.sha256(
+                f"{rules_hash}:{SEMGREP_OPTIONS_VERSION}".encode()
+            ).hexdigest()
+
+            # Results are written under a new run and each plugin switches over to them as its
+            # audit completes, so readers of LatestPluginResults never see a half empty table.
+            # --clear-results audits everything again and then drops whatever wasn't audited.
+            force_audit = args.force_audit or args.clear_results
+            run_id = db.start_audit_run(cursor, rules_hash)
+            db_conn.commit()
+            if args.bulk_load:
+                writer = BulkResultWriter(
+                    db_conn,
+                    cursor,
+                    run_id,
+                    args.bulk_load_rows,
+                    args.spool_dir,
+                    args.compress_snippets,
+                    args.snippet_cache_size,
+                )
+            else:
+                writer = ResultWriter(
+                    db_conn,
+                    cursor,
+                    run_id,
+                    args.insert_batch_size,
+                    args.commit_rows,
+                    args.compress_snippets,
+                    args.snippet_cache_size,
+                )
+
+            # Meanwhile clear out results that earlier runs left behind. SQLite only has one
+            # writer at a time, so there it all waits for the end of the run.
+            pruner = threading.Thread(
+                target=prune_superseded_results,
+                args=(run_id, args.prune_chunk_size),
+                daemon=True,
+            )
+            if db is dbutils:
+                pruner.start()
 
         # Write plugins to CSV, Database, and possibly download them
         if args.download:
-            write_plugins_to_csv_db_and_download(
-                db_conn, cursor, args.download_dir, args.verbose
+            download_options = dict(
+                per_page=args.per_page,
+                trim_fields=not args.all_fields,
+                catalog_workers=args.catalog_workers,
+                download_workers=args.download_workers,
+                incremental=args.incremental,
+                force_download=args.force_download,
+                upsert_batch_size=args.upsert_batch_size,
             )
-        if args.audit:
+            if args.audit and args.pipeline:
+                download_and_audit_plugins(
+                    db_conn,
+                    cursor,
+                    writer,
+                    session,
+                    args.download_dir,
+                    rules,
+                    audit_workers=audit_workers,
+                    semgrep_jobs=semgrep_jobs,
+                    batch_bytes=args.batch_mb * 1024 * 1024,
+                    batch_files=args.batch_files,
+                    rules_hash=rules_hash,
+                    force_audit=force_audit,
+                    file_cache=args.file_cache or args.dedupe_files,
+                    dedupe=args.dedupe_files,
+                    queue_size=args.audit_queue_size,
+                    queue_bytes=args.audit_queue_mb * 1024 * 1024,
+                    verbose=args.verbose,
+                    **download_options,
+                )
+            else:
+                write_plugins_to_csv_db_and_download(
+                    db_conn,
+                    cursor,
+                    session,
+                    args.download_dir,
+                    verbose=args.verbose,
+                    **download_options,
+                )
+        if args.audit and not (args.download and args.pipeline):
             run_semgrep_and_store_results(
-                db_conn, cursor, args.download_dir, args.config, args.verbose
+                db_conn,
+                cursor,
+                writer,
+                args.download_dir,
+                rules,
+                audit_workers,
+                semgrep_jobs,
+                args.batch_mb * 1024 * 1024,
+                args.batch_files,
+                rules_hash,
+                force_audit,
+                args.file_cache or args.dedupe_files,
+                args.dedupe_files,
+                args.verbose,
+            )
+
+        if args.audit:
+            # Load anything still spooled in --bulk-load mode
+            writer.close()
+            if args.clear_results:
+                db.forget_earlier_audits(cursor, run_id, writer.failed)
+            db.complete_audit_run(cursor, run_id)
+            db_conn.commit()
+
+            # Then prune the results this run replaced
+            if pruner.is_alive():
+                pruner.join()
+            prune_superseded_results(run_id, args.prune_chunk_size)
+            prune_orphaned_snippets(args.prune_chunk_size)
+
+        # Stream both tables out to Parquet, using a fresh cursor so MySQL doesn't buffer the
+        # whole result set
+        if args.export_parquet:
+            export_cursor = db_conn.cursor()
+            export_to_parquet(
+                db.iter_plugin_data(export_cursor, args.export_chunk_size),
+                db.iter_latest_results(export_cursor, args.export_chunk_size),
+                args.export_parquet,
             )
+            export_cursor.close()
 
         cursor.close()
         db_conn.close()